@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+# floambench.py (Copyright 2008 Aaron Gyes)
+# distributed under the GPLv3. See LICENSE
+
+"""
+Benchmarks for floamtv.py. Never touches your real database or config, and
+never talks to TVRage, Newzbin or SABnzbd. Run with the names of the
+benchmarks you want, or with none to run all of them:
+
+   floambench.py [--shows 1000] [--latency 0.05] [refresh newzbin ...]
+
+The network benchmarks run against local stand-ins for the real services,
+which answer after --latency seconds, with a made up config of --shows
+shows. The end of the run reports the peak resident set size of the whole
+process.
+"""
+
+from __future__ import with_statement
+import os, sys, gc, time, types, shutil, tempfile, subprocess, yaml
+import resource as rusage
+from datetime import datetime as dt, timedelta
+from twisted.internet import reactor, defer, error, threads
+from twisted.python import usage
+from twisted.web import resource, server, xmlrpc
+
+import floamtv
+
+class Options(usage.Options):
+   optParameters = [
+      ['episodes', 'e', 50000, 'Number of episodes in the synthetic collection',
+       int],
+      ['shows',    's', 1000,  'Number of shows in the synthetic config', int],
+      ['repeat',   'r', 3,     'Best of how many runs', int],
+      ['latency',  'l', 0.05,  'Seconds the stand-in services take to answer',
+       float],
+      ['ready',    None, 36,   'Episodes ready to enqueue at once', int],
+      ['calls',    None, 500,  'XML-RPC calls to make per method', int],
+      ['storage',  None, 'file', 'Storage to save to, file or sqlite'],
+   ]
+
+   def parseArgs(self, *names):
+      for name in names:
+         if name not in benchmarks:
+            raise usage.UsageError("No benchmark called %r" % name)
+      self['benchmarks'] = names or sorted(benchmarks)
+
+class FakeService(resource.Resource):
+   """
+   A stand-in for one of the services floamtv talks to. Answers every GET
+   with whatever answer() returns, after latency seconds.
+   """
+   isLeaf = True
+
+   def __init__(self, latency):
+      resource.Resource.__init__(self)
+      self.latency = latency
+
+   def render_GET(self, request):
+      def _answer():
+         request.write(self.answer(request.args))
+         request.finish()
+
+      reactor.callLater(self.latency, _answer)
+      return server.NOT_DONE_YET
+
+class FakeTVRage(FakeService):
+   """
+   Answers quickinfo.php. Every show's latest episode is 01x05, which aired
+   two days ago, and the next one is 01x06, a week from now. Episode e of
+   Show n has TVRage ID 100000 + 100 * n + e.
+   """
+
+   def answer(self, args):
+      show = args['show'][0]
+      if not show.startswith('Show '):
+         return 'No Show Results Were Found For "%s"' % show
+
+      n = int(show.split()[1])
+      latest = dt.now() - timedelta(days=2)
+      upcoming = dt.now() + timedelta(days=7)
+      ep = args.get('ep', [''])[0]
+      if not ep:
+         return '\n'.join([
+            'Show Name@%s' % show,
+            'Latest Episode@01x05^Episode 5^%s' % latest.strftime('%b/%d/%Y'),
+            'Next Episode@01x06^Episode 6^%s' % upcoming.strftime('%b/%d/%Y'),
+            'Airtime@Thursday at 09:00 pm'])
+
+      airs = ep == '01x05' and latest or upcoming
+      return '\n'.join([
+         'Show Name@%s' % show,
+         'Episode URL@http://www.tvrage.com/Show_%d/episodes/%d'
+            % (n, 100000 + 100 * n + int(ep.split('x')[1])),
+         'Episode Info@%s^Episode %s^%s' % (ep, ep, airs.strftime('%d/%b/%Y')),
+         'Airtime@Thursday at 09:00 pm'])
+
+class FakeNewzbin(FakeService):
+   """
+   Answers Newzbin's CSV search feed. Every episode that already aired has
+   three posts, newest first, of 200, 300 and 400 MB.
+   """
+
+   def answer(self, args):
+      tvrageids = [int(i) for i in args['q_url'][0].split(' or ') if i]
+      rows = []
+      for post in range(3):
+         for tvrageid in tvrageids:
+            if tvrageid % 100 <= 5:
+               rows.append('"%s","%d","A Post","http://x/","http://www.'
+                           'tvrage.com/Show/episodes/%d","%d",'
+                           '"alt.binaries.tv"' % (dt.now(), tvrageid * 10 -
+                           post, tvrageid, (200 + 100 * post) * 1048576))
+      return '\n'.join(rows[:int(args['u_post_results_amt'][0])])
+
+class FakeSab(FakeService):
+   """
+   Answers SABnzbd's addid API like SABnzbd would. Remembers every Newzbin ID
+   it was given in added.
+   """
+
+   def __init__(self, latency):
+      FakeService.__init__(self, latency)
+      self.added = []
+
+   def answer(self, args):
+      if args.get('mode') == ['addid']:
+         self.added.append(int(args['name'][0]))
+         return 'ok\n'
+      return 'error: not implemented\n'
+
+class DictEpisode(object):
+   "An Episode the way they were kept before they had __slots__."
+
+   def __init__(self, ep):
+      self.show = ep.show[:1] + ep.show[1:]
+      self.number = ep.number
+      self.title = ep.title
+      self.tvrageid = ep.tvrageid
+      self.airs = ep.airs
+      self.newzbinid = ep.newzbinid
+      self.wanted = ep.wanted
+
+class Idle(object):
+   "Stands in for the daemon's newzbin Poller, which refresh() restarts."
+   running = False
+   def start(self): pass
+   def stop(self): pass
+   def reschedule(self): pass
+
+def listen(site):
+   "Starts site on a free local port, returns the port number."
+   return reactor.listenTCP(0, server.Site(site),
+                            interface='127.0.0.1').getHost().port
+
+def best_of(n, f, *a, **kw):
+   "Runs f n times, returns the fastest wall-clock time in seconds."
+   times = []
+   for i in range(n):
+      start = time.time()
+      f(*a, **kw)
+      times.append(time.time() - start)
+   return min(times)
+
+def footprint(objs):
+   """
+   Roughly how many bytes objs take up, along with everything they refer to
+   that isn't a class, function or module. Shared objects count once.
+   """
+   skip = (type, types.ClassType, types.FunctionType, types.ModuleType)
+   seen = set()
+   total = 0
+   todo = list(objs)
+   while todo:
+      o = todo.pop()
+      if id(o) in seen or isinstance(o, skip):
+         continue
+      seen.add(id(o))
+      total += sys.getsizeof(o)
+      todo.extend(gc.get_referents(o))
+   return total
+
+def percentiles(samples):
+   "p50, p90 and p99 of samples, which are in seconds, as a string."
+   samples = sorted(samples) or [0]
+   at = lambda p: 1000 * samples[min(len(samples) - 1, len(samples) * p / 100)]
+   return "p50 %.1fms, p90 %.1fms, p99 %.1fms" % (at(50), at(90), at(99))
+
+def timed_requests():
+   """
+   Wraps floamtv.get_page so the latency of every request it makes from now
+   on is appended to the returned list. get_page keeps its connection pool
+   on whatever floamtv.get_page is, so the pool moves along.
+   """
+   def _timed(url, **kw):
+      def _done(result, start):
+         samples.append(time.time() - start)
+         return result
+      return get_page(url, **kw).addBoth(_done, time.time())
+
+   samples = []
+   _timed.pool = floamtv.get_page.pool
+   floamtv.get_page = _timed
+   return samples
+
+get_page = floamtv.get_page
+
+def synthetic_collection(episodes, per_show=10):
+   "Builds a Collection of made up shows without asking TVRage."
+   ss = floamtv.Collection()
+   start = dt(2008, 1, 1, 21)
+
+   for n in range(0, episodes, per_show):
+      show = floamtv.Show('Show %d' % (n / per_show), 'US/Eastern')
+      for i in range(n, min(n + per_show, episodes)):
+         airs = floamtv.pytz.utc.localize(start + timedelta(hours=i))
+         ep = floamtv.Episode(show.title, '%02dx%02d' % (i / 100, i % 100),
+                              'Episode %d' % i, 10000 + i, airs)
+         ep.wanted = bool(i % 3)
+         ep.newzbinid = 3000000 + i if i % 5 == 0 else None
+         show.episodes.append(ep)
+      ss.shows.append(show)
+
+   ss._reindex()
+   return ss
+
+def synthetic_sets(shows):
+   "A config's sets, covering shows made up shows in two timezones."
+   rules = { 'min-megs': 100, 'max-megs': 800, 'groups': ['alt.binaries.tv'] }
+   return [{ 'shows': ['Show %d' % n for n in range(first, shows, 2)],
+             'timezone': timezone, 'rules': rules }
+           for first, timezone in ((0, 'US/Eastern'), (1, 'Europe/London'))]
+
+@defer.inlineCallbacks
+def world(opts):
+   """
+   Starts the stand-in services, points floamtv at them and refreshes a
+   Collection of --shows shows from them. Only the first call does any of
+   that, the rest get the same world back.
+   """
+   if not world.cache:
+      tvrage = FakeTVRage(opts['latency'])
+      newzbin = FakeNewzbin(opts['latency'])
+      sab = FakeSab(opts['latency'])
+      floamtv.config.update({
+         'sets': synthetic_sets(opts['shows']),
+         'tvrage-url': 'http://127.0.0.1:%d/' % listen(tvrage),
+         'newzbin-url': 'http://127.0.0.1:%d/' % listen(newzbin),
+         'nzbclient': 'sab',
+         'sabnzbd-host': 'localhost',
+         'sabnzbd-port': listen(sab) })
+      floamtv.tasks['newzbin'] = Idle()
+
+      showset = floamtv.Collection()
+      samples = timed_requests()
+      start = time.time()
+      yield showset.refresh(floamtv.config['sets'])
+      world.cache = { 'showset': showset, 'sab': sab,
+                      'refresh': (time.time() - start, samples) }
+
+   defer.returnValue(world.cache)
+
+world.cache = None
+
+@defer.inlineCallbacks
+def bench_refresh(opts):
+   "TVRage refresh of every show, first brand new and then already known"
+   w = yield world(opts)
+   secs, samples = w['refresh']
+   print "refresh, %d shows:" % opts['shows']
+   print "   new    %5d requests %7.2fs %7.1f/s, %s" % (len(samples), secs,
+         len(samples) / secs, percentiles(samples))
+
+   samples = timed_requests()
+   start = time.time()
+   yield w['showset'].refresh(floamtv.config['sets'])
+   secs = time.time() - start
+   print "   known  %5d requests %7.2fs, %s" % (len(samples), secs,
+         percentiles(samples))
+
+@defer.inlineCallbacks
+def bench_newzbin(opts):
+   "Newzbin search for every episode, and enqueueing what turns up"
+   w = yield world(opts)
+   print "newzbin, %d shows in %d sets:" % (opts['shows'],
+                                            len(floamtv.config['sets']))
+
+   for once in (False, True):
+      floamtv.config['newzbin-fetch-once'] = once
+      for ep in w['showset']._episodes():
+         ep.newzbinid = None
+         ep.wanted = True
+      sent = len(w['sab'].added)
+      samples = timed_requests()
+      start = time.time()
+      yield w['showset'].look_on_newzbin()
+      secs = time.time() - start
+
+      print "   %-10s %d requests %.2fs, %d enqueued, %s" % (once and
+            'fetch once' or 'per set', len(samples), secs,
+            len(w['sab'].added) - sent, percentiles(samples))
+
+@defer.inlineCallbacks
+def bench_status(opts):
+   "Rendering the status listing"
+   w = yield world(opts)
+   print "status, %d episodes:" % len(list(w['showset']._episodes()))
+   print "   %.3fs" % best_of(opts['repeat'], w['showset'].status, True)
+
+@defer.inlineCallbacks
+def bench_save(opts):
+   "Saving and loading the refreshed Collection"
+   w = yield world(opts)
+   showset = w['showset']
+   ep = showset._episodes().next()
+
+   def change_one():
+      ep.wanted = not ep.wanted
+      showset.flush()
+
+   print "save, %d episodes, %s storage:" % (len(list(showset._episodes())),
+                                             opts['storage'])
+   print "   snapshot %.3fs" % best_of(opts['repeat'], showset.snapshot)
+   print "   journal  %.3fs" % best_of(opts['repeat'], change_one)
+   print "   load     %.3fs" % best_of(opts['repeat'], floamtv.load)
+
+@defer.inlineCallbacks
+def bench_xmlrpc(opts):
+   "XML-RPC calls against the daemon's listener, ten at a time"
+   w = yield world(opts)
+   root = resource.Resource()
+   root.putChild('', w['showset'])
+   proxy = xmlrpc.Proxy('http://127.0.0.1:%d/' % listen(root))
+   ids = [floamtv.humanize(e.tvrageid) for e in w['showset']._episodes()]
+
+   def call(method, args, samples):
+      def _done(result, start):
+         samples.append(time.time() - start)
+      return proxy.callRemote(method, *args).addCallback(_done, time.time())
+
+   print "xmlrpc, %d calls each:" % opts['calls']
+   for method in ('status', 'unwant', 'rewant'):
+      samples = []
+      start = time.time()
+      for first in range(0, opts['calls'], 10):
+         calls = range(first, min(first + 10, opts['calls']))
+         yield defer.gatherResults([call(method, method == 'status' and
+                                         (False,) or (ids[i % len(ids)],),
+                                         samples) for i in calls])
+      secs = time.time() - start
+      print "   %-6s %7.1f/s, %s" % (method, len(samples) / secs,
+                                     percentiles(samples))
+
+def bench_load(opts):
+   "Old YAML database against snapshots, see floamtv.load()"
+   ss = synthetic_collection(opts['episodes'])
+
+   def yaml_load(loader):
+      with open(floamtv.dbpath) as f:
+         yaml.load(f, Loader=loader)
+
+   with open(floamtv.dbpath, 'w') as f:
+      yaml.dump(ss, f, indent=4, default_flow_style=False)
+
+   results = [('yaml', best_of(opts['repeat'], yaml_load, yaml.Loader))]
+   if hasattr(yaml, 'CLoader'):
+      results.append(('libyaml', best_of(opts['repeat'], yaml_load,
+                                          yaml.CLoader)))
+
+   ss.snapshot()
+   results.append(('snapshot', best_of(opts['repeat'], floamtv.load)))
+
+   print "load, %d episodes:" % opts['episodes']
+   for name, secs in results:
+      print "   %-10s %8.3fs %7.1fx" % (name, secs, results[0][1] / secs)
+
+def bench_memory(opts):
+   "Memory taken by Episodes, against how they used to be kept"
+   eps = list(synthetic_collection(opts['episodes'])._episodes())
+   results = [('dict', footprint([DictEpisode(e) for e in eps])),
+              ('slots', footprint(eps))]
+
+   print "memory, %d episodes:" % len(eps)
+   for name, size in results:
+      print "   %-10s %8.1f MB %7d bytes each" % (name, size / 1048576.0,
+                                                  size / len(eps))
+
+@defer.inlineCallbacks
+def bench_sab(opts):
+   "A season's worth of episodes becoming ready at once, see SabQueue"
+   w = yield world(opts)
+   sab = w['sab']
+   sent = len(sab.added)
+
+   eps = list(synthetic_collection(opts['ready'])._episodes())
+   for ep in eps:
+      ep.newzbinid = ep.tvrageid
+   start = time.time()
+   yield defer.DeferredList([floamtv.enqueue_episodes(eps),
+                             floamtv.enqueue_episodes(eps)])
+   secs = time.time() - start
+
+   print "sab, %d episodes submitted twice:" % len(eps)
+   print "   %d requests, %d enqueued, %.3fs (%.1f round trips)" \
+      % (len(sab.added) - sent, len([e for e in eps if not e.wanted]), secs,
+         secs / opts['latency'])
+
+@defer.inlineCallbacks
+def bench_startup(opts):
+   "Command lines against a running daemon, against importing all of floamtv"
+   w = yield world(opts)
+   root = resource.Resource()
+   root.putChild('', w['showset'])
+   try:
+      port = reactor.listenTCP(19666, server.Site(root), interface='127.0.0.1')
+   except error.CannotListenError:
+      print "startup: port 19666 is taken, is floamtv running?"
+      return
+
+   home = os.path.dirname(floamtv.dbpath)
+   with open(os.path.join(home, '.floamtvpid'), 'w') as f:
+      f.write("%d" % os.getpid())
+   script = os.path.splitext(os.path.abspath(floamtv.__file__))[0] + '.py'
+
+   def command(*args):
+      with open(os.devnull, 'w') as devnull:
+         subprocess.check_call((sys.executable,) + args, stdout=devnull,
+                               env=dict(os.environ, HOME=home),
+                               cwd=os.path.dirname(script))
+
+   results = []
+   try:
+      for name, args in (('python', ('-c', 'pass')),
+                         ('--status', (script, '--status')),
+                         ('--unwant', (script, '--unwant', 'x')),
+                         ('import', ('-c', 'import floamtv'))):
+         secs = yield threads.deferToThread(best_of, opts['repeat'], command,
+                                            *args)
+         results.append((name, secs))
+   finally:
+      port.stopListening()
+
+   print "startup, best of %d:" % opts['repeat']
+   for name, secs in results:
+      print "   %-10s %8.3fs" % (name, secs)
+
+benchmarks = {
+   'load': bench_load,
+   'memory': bench_memory,
+   'newzbin': bench_newzbin,
+   'refresh': bench_refresh,
+   'sab': bench_sab,
+   'save': bench_save,
+   'startup': bench_startup,
+   'status': bench_status,
+   'xmlrpc': bench_xmlrpc,
+}
+
+@defer.inlineCallbacks
+def run(opts):
+   try:
+      for name in opts['benchmarks']:
+         yield defer.maybeDeferred(benchmarks[name], opts)
+      peak = rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+      print "peak RSS: %.1f MB" % (peak / 1024.0)
+   finally:
+      reactor.stop()
+
+def main():
+   opts = Options()
+   opts.parseOptions()
+
+   scratch = tempfile.mkdtemp(prefix='floambench')
+   floamtv.dbpath = os.path.join(scratch, 'floamtvdb2')
+   floamtv.cachepath = os.path.join(scratch, 'floamtvcache')
+   floamtv.sqlitepath = os.path.join(scratch, 'floamtv.sqlite')
+   floamtv.config = dict(floamtv.defaults['config'])
+   floamtv.config['save-delay'] = 0
+   floamtv.config['storage'] = opts['storage']
+   # Only the TVRage and Newzbin stand-ins are let off the rate limits,
+   # SABnzbd's is reached as localhost and keeps the shipped ones.
+   floamtv.config['hosts'] = { '127.0.0.1': { 'max-connections': 10,
+                                              'requests-per-minute': 60000 } }
+   try:
+      reactor.callWhenRunning(lambda: run(opts).addErrback(
+                                 lambda err: err.printTraceback()))
+      reactor.run()
+   finally:
+      shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+   sys.exit(main())
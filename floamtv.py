@@ -9,39 +9,149 @@ http://aaron.gy/stuff/floamtv
 """
 
 from __future__ import with_statement
-import re, os, csv, yaml, sys, errno, atexit, pytz, shutil, resource, logging
-import twisted, base64
-from cStringIO import StringIO
-from twisted.internet import reactor, task, defer
+import os, sys, errno, getopt
+
+dbpath = os.path.expanduser('~/.floamtvdb2')
+configpath = os.path.expanduser('~/.floamtvconfig2')
+pidfile = os.path.expanduser('~/.floamtvpid')
+cachepath = os.path.expanduser('~/.floamtvcache')
+sqlitepath = os.path.expanduser('~/.floamtv.sqlite')
+version = "internal"
+snapshot_magic = 'floamtv snapshot\n'
+snapshot_version = 1
+
+def check_pid():
+   if os.path.exists(pidfile):
+      with open(pidfile) as f:
+         pid = f.read()
+      
+      try:
+         os.kill(int(pid), 0)
+      except os.error, err:
+         if err.errno == errno.ESRCH:
+            os.unlink(pidfile)
+      else:
+         return int(pid)
+
+def as_client(argv):
+   """
+   Does what a command line only needs a running daemon for, before paying
+   for the daemon's imports. Returns False if main() has to do it instead.
+   """
+   short = { '-s': 'status', '-v': 'verbose', '-k': 'shutdown' }
+   try:
+      opts, args = getopt.gnu_getopt(argv, 'svk', ['status', 'verbose',
+                                     'shutdown', 'profile', 'unwant=',
+                                     'rewant='])
+   except getopt.GetoptError:
+      return False
+   
+   pid = check_pid()
+   if not opts or args or pid is None or pid == os.getpid():
+      return False
+   
+   from xmlrpclib import ServerProxy
+   opts = dict((short.get(o, o[2:]), v) for o, v in opts)
+   showset = ServerProxy('http://localhost:19666/')
+   
+   if 'shutdown' in opts:
+      os.kill(pid, 15)
+   
+   if 'status' in opts:
+      print "Daemon is running."
+   
+   if 'unwant' in opts:
+      for out in showset.unwant_many(opts['unwant'].split()):
+         print out
+   
+   elif 'rewant' in opts:
+      for out in showset.rewant_many(opts['rewant'].split()):
+         print out
+   
+   elif 'status' in opts:
+      print showset.status('verbose' in opts)
+   
+   elif 'profile' in opts:
+      print showset.profile()
+   
+   return True
+
+if __name__ == '__main__' and as_client(sys.argv[1:]):
+   sys.exit()
+
+import re, csv, yaml, atexit, pytz, shutil, resource, logging
+import twisted, base64, marshal, calendar, time, heapq, urlparse, cProfile
+import thread, threading, traceback, itertools
+from twisted.internet import reactor, defer, protocol, threads
 from pytz.reference import Local as localtz
 from twisted.web import xmlrpc, server, client
-from twisted.python import usage, log
+from twisted.web.resource import Resource
+from twisted.python import usage, log, failure
 from twisted.web.client import getPage
+try:
+   from twisted.web.client import Agent, HTTPConnectionPool, readBody
+   from twisted.web.client import RedirectAgent
+   from twisted.web.client import ResponseDone
+   from twisted.web.http import PotentialDataLoss
+   from twisted.web.http_headers import Headers
+except ImportError:
+   HTTPConnectionPool = None
 from urllib import urlencode
-from xmlrpclib import ServerProxy
+from xmlrpclib import ServerProxy, MultiCall, Fault, Transport
 from datetime import datetime as dt, timedelta
 from collections import defaultdict
-
-dbpath = os.path.expanduser('~/.floamtvdb2')
-configpath = os.path.expanduser('~/.floamtvconfig2')
-pidfile = os.path.expanduser('~/.floamtvpid')
-version = "internal"
+try:
+   import sqlite3
+except ImportError:
+   sqlite3 = None
 
 tasks = {}
+ENQUEUE, SEARCH, REFRESH = range(3)
+rowcap = 999
 tr = re.compile(r"tvrage\.com/.*/([\d]{4,})")
 
 defaults = {
    'config': { 'logfile': None,
                'max-connections': 3,
+               'requests-per-minute': 60,
+               'hosts': dict(),
+               'pool-size': 2,
+               'pool-idle': 240,
                'hellanzb-pass': 'changeme',
                'nzbclient': 'hella',
                'sabnzbd-host': 'localhost',
                'sabnzbd-port': 8080,
                'sabnzbd-apikey': 'changeme',
+               'sab-retries': 5,
+               'sab-retry': 30,
+               'sab-max-connections': 10,
+               'sab-requests-per-minute': 600,
                'hellanzb-host': 'localhost',
                'newzbin-interval': 8,
+               'newzbin-max-interval': 120,
+               'newzbin-window': 24,
                'tvrage-interval': 500,
+               'tvrage-slack': 60,
+               'tvrage-max-shows': 100,
                'retention': 100,
+               'tvrage-url': 'http://tvrage.com/quickinfo.php',
+               'newzbin-url': 'https://www.newzbin.com/search/',
+               'newzbin-batch': 50,
+               'newzbin-fetch-once': False,
+               'newzbin-title-column': 2,
+               'newzbin-size-column': 5,
+               'newzbin-groups-column': 6,
+               'journal-size': 512,
+               'save-delay': 2,
+               'storage': 'file',
+               'cache-size': 5000,
+               'cache-ttl': 60,
+               'cache-aired-ttl': 168,
+               'profile-dir': '~/.floamtvprofiles',
+               'profile-keep': 100,
+               'stall-threshold': 1.0,
+               'changes-kept': 1000,
+               'changes-timeout': 60,
                'port': 19666,
                'bind': '',
                'sets': list() },
@@ -62,17 +172,32 @@ class Collection(yaml.YAMLObject, xmlrpc.XMLRPC):
    do things to our collection of Shows.
    
    An individual episode can be chosen through Collection[id], where id is a
-   humanize()'d version of the TVRage ID.
+   humanize()'d version of the TVRage ID. Lookups go through an index that
+   Shows keep current as they gain and lose episodes.
    """
    
    yaml_tag = '!Collection'
    allowNone = False
+   useDateTime = False
+   journaled = ('wanted', 'newzbinid', 'airs', 'title', 'probation',
+                'tvrageid')
+   _persisted = None
+   _compact = False
+   _save_call = _writing = None
+   _upcoming = _airings = None
+   _probation_timer = None
+   _following = False
+   _idle = 0
+   
    def __init__(self, sets=None):
       self.shows = []
+      self._waiting = []
+      self._due = set()
+      self._reindex()
       if sets:
          self.refresh(sets)
    
-   def refresh(self, sets, _firstrun=False):
+   def refresh(self, sets, _firstrun=False, only=None):
       """
       Populate this Collection with new show information from TVRage. Existing
       Shows have new episodes added to them and the rest are updated with new 
@@ -84,65 +209,47 @@ class Collection(yaml.YAMLObject, xmlrpc.XMLRPC):
          ...
       ]
       
-      Rules don't affect this step at all.
+      Rules don't affect this step at all. If only is given, just the existing
+      Shows in it are asked about: shows aren't added or pruned (see
+      follow()), and a running Newzbin poller is only rescheduled around the
+      new airtimes rather than restarted.
       """
       
       logging.info('Getting new data from TVRage.')
+      def _start(x):
+         self._build_airtimes()
+         if _firstrun:
+            print "Quitting early to give you a chance to catch up."
+            if reactor.running: reactor.stop()
+         elif not tasks['newzbin'].running:
+            tasks['newzbin'].start()
+      
       def _check_for_brand_new_shows(_):
-         def _start(x):
-            if _firstrun:
-               print "Quitting early to give you a chance to catch up."
-               if reactor.running: reactor.stop()
-            elif not tasks['newzbin'].running:
-               tasks['newzbin'].start(60*config['newzbin-interval'])
-         
-         shows = set()
-         tz = {}
-         
-         for a in sets:
-            try:
-               tz.update((s, a['timezone']) for s in a['shows'])
-               shows.update(a['shows'])
-            except TypeError:
-               if reactor.running: reactor.stop()
-               raise Exception, "You may have a colon in a show name. Shows " \
-                                "with colons need to be enclosed in quotes."
-               
-         alreadyin = dict((t.title, t) for t in self.shows)
-         newshows = []
-
-         def new_show(info, timezone):
-            if info:
-               new_show = Show(info['wecallit'], timezone)
-               dfrd = new_show.update(info)
-               self.shows.append(new_show)
-               return dfrd
-         
-         maxcon = min(10, int(config['max-connections']))
-         ds = defer.DeferredSemaphore(tokens=maxcon)
-         
-         for show in shows.symmetric_difference(alreadyin):
-            if show not in alreadyin:
-               newshow = ds.run(tvrage_info, show, None)
-               newshow.addCallbacks(new_show, tvrageerr, (tz[show],))
-               newshow.addErrback(getpage_err)
-               newshows.append(newshow)
-            
-            elif show not in shows:
-               logging.info("Pruning %s" % alreadyin[show])
-               self.shows.remove(alreadyin[show])
-         
-         ns = defer.DeferredList(newshows)
+         ns = self.follow(sets)
          ns.addCallback(_start)
          ns.addCallback(lambda _: self.save())
+         ns.addCallback(lambda _: tvcache.sync())
+         ns.addCallback(lambda _: log_connection_stats())
          
          return ns
-         
-      if tasks.has_key('newzbin') and tasks['newzbin'].running:
+      
+      def _reschedule(_):
+         self._build_airtimes()
+         if not tasks['newzbin'].running:
+            tasks['newzbin'].start()
+         else:
+            tasks['newzbin'].reschedule()
+         if tvcache.synced <= time.time() - 60 * config['tvrage-interval']:
+            tvcache.sync()
+         return self.save()
+      
+      if only is None and tasks.has_key('newzbin') \
+            and tasks['newzbin'].running:
          tasks['newzbin'].stop()
       
       pageinfos = []
-      for show in self.shows:
+      for show in (self.shows if only is None else only):
+         show.fetched = time.time()
          ashow = tvrage_info(show.title, None)
          ashow.addCallback(show.update)
          ashow.addErrback(tvrageerr)
@@ -150,25 +257,96 @@ class Collection(yaml.YAMLObject, xmlrpc.XMLRPC):
          pageinfos.append(ashow)
          
       pageinfos = defer.DeferredList(pageinfos)
-      pageinfos.addCallback(_check_for_brand_new_shows)
+      if only is None:
+         pageinfos.addCallback(_check_for_brand_new_shows)
+      else:
+         pageinfos.addCallback(_reschedule)
       
       return pageinfos
    
+   def follow(self, sets):
+      """
+      Adds the shows in sets that this Collection doesn't have yet, asking
+      TVRage about them, and prunes the ones no longer in sets. Returns a
+      DeferredList of the new shows.
+      """
+      shows = set()
+      tz = {}
+      
+      for a in sets:
+         try:
+            tz.update((s, a['timezone']) for s in a['shows'])
+            shows.update(a['shows'])
+         except TypeError:
+            if reactor.running: reactor.stop()
+            raise Exception, "You may have a colon in a show name. Shows " \
+                             "with colons need to be enclosed in quotes."
+            
+      alreadyin = dict((t.title, t) for t in self.shows)
+      newshows = []
+
+      def new_show(info, timezone):
+         if info:
+            new_show = Show(info['wecallit'], timezone)
+            new_show.collection = self
+            new_show.fetched = time.time()
+            dfrd = new_show.update(info)
+            self.shows.append(new_show)
+            return dfrd
+      
+      for show in shows.symmetric_difference(alreadyin):
+         if show not in alreadyin:
+            newshow = tvrage_info(show, None)
+            newshow.addCallbacks(new_show, tvrageerr, (tz[show],))
+            newshow.addErrback(getpage_err)
+            newshows.append(newshow)
+         
+         elif show not in shows:
+            logging.info("Pruning %s" % alreadyin[show])
+            self.shows.remove(alreadyin[show])
+            for ep in alreadyin[show].episodes:
+               self._unindex(ep)
+      
+      return defer.DeferredList(newshows)
+   
    def status(self, verbose):
       """
       Returns a pretty listing of shows we know about. If verbose is True,
       all shows we know about are included, else only wanted shows.
       """
+      today = dt.now(localtz).date()
+      out = ["", " Episodes", " ========", ""]
+      for floamid, show, number, title, airtime, wanted, _ \
+            in self.episodes(None if verbose else True):
+         out.append("  (%c) %s - %s - %s, [%s]" % ('+' if wanted else ' ',
+                                                   show, number, title,
+                                                   floamid))
+         out.append("      (%s)\n" % relative_datetime(from_epoch(airtime),
+                                                        today))
+      out.append("  ( ) = unwanted, (+) = wanted")
       
-      out = "\n Episodes\n"\
-             " ========\n\n"
-      for ep in sorted(self._episodes(), key=lambda e: e.show):
-         if ep.wanted or verbose:
-            out += "  (%c) %s\n" % ('+' if ep.wanted else ' ', ep)
-            out += "      (%s)\n\n" % relative_datetime(ep.airs)
-      out += "  ( ) = unwanted, (+) = wanted"
+      return "\n".join(out)
+   
+   def episodes(self, wanted=None, show=None, aired_after=None,
+                aired_before=None, offset=0, limit=None):
+      """
+      Episodes as (floamid, show, number, title, airtime, wanted, newzbinid)
+      tuples, ordered by show. wanted=True takes episodes we want, including
+      those on probation, and False the rest. The aired_ times are seconds
+      since the epoch. Filters left as None match everything.
+      """
+      rows = ((humanize(e.tvrageid), e.show, e.number, e.title, e.airtime,
+               e.wanted, e.newzbinid)
+              for s in sorted(self.shows, key=lambda s: s.title)
+              if show is None or s.title == show for e in s.episodes
+              if (wanted is None or bool(e.wanted) == wanted)
+              and (aired_after is None
+                   or e.airtime is not None and e.airtime >= aired_after)
+              and (aired_before is None
+                   or e.airtime is not None and e.airtime < aired_before))
       
-      return out
+      return list(itertools.islice(rows, offset,
+                                   None if limit is None else offset + limit))
    
    def look_on_newzbin(self, allow_probation=False):
       """
@@ -183,50 +361,211 @@ class Collection(yaml.YAMLObject, xmlrpc.XMLRPC):
       """
       
       def _enqueue_new_stuff(results):
+         ready = []
          for e in (ep for ep in self._episodes() if ep.wanted and ep.newzbinid):
             if e.airs and e.airs > dt.now(pytz.utc):
-               if not allow_probation:
-                  e.was_fake(sure=False)
-            else:
-               e.enqueue(allow_probation)
-         self.save()
+               if not allow_probation and e.was_fake(sure=False):
+                  self.put_on_probation(e)
+            elif e.may_enqueue(allow_probation):
+               ready.append(e)
+         
+         enqueued = enqueue_episodes(ready)
+         enqueued.addCallback(lambda _: self.save())
+         return enqueued
          
       logging.info('Looking for new shows on newzbin.')
       
-      dfrds = []
+      if config['newzbin-fetch-once']:
+         searches = self._search_once()
+      else:
+         dfrds = []
+         for ruleset in config['sets']:
+            inset = [e for e in self._episodes() if e.show in ruleset['shows']]
+            rdict = dict(defaults['rules'].items() + ruleset['rules'].items())
+            dfrds.append(search_newzbin(inset, rdict))
+         searches = defer.DeferredList(dfrds)
+      
+      searches.addCallback(_enqueue_new_stuff)
+      return searches
+   
+   def _search_once(self):
+      """
+      With newzbin-fetch-once, rather than one search per set, every episode
+      of every set is searched for at once without any rules, and each set's
+      rules are applied to the posts that turn up here, see rule_matcher().
+      An episode in more than one set gets the newest post any of them likes.
+      Sets whose query rule_matcher() can't check, like attribute searches,
+      are still searched for on their own.
+      """
+      def _accepts(e, post):
+         return [m for shows, m in sets if e.show in shows and m(post)]
+      
+      def _match(_):
+         for e in eps:
+            for post in posts.get(e.tvrageid, ()):
+               if _accepts(e, post):
+                  if e.newzbinid != post[0]:
+                     e.newzbinid = post[0]
+                     changelog.record('found', e)
+                  break
+      
+      sets = []
+      searches = []
       for ruleset in config['sets']:
-         inset = [e for e in self._episodes() if e.show in ruleset['shows']]
          rdict = dict(defaults['rules'].items() + ruleset['rules'].items())
-         dfrds.append(search_newzbin(inset, rdict))
+         try:
+            sets.append((set(ruleset['shows']), rule_matcher(rdict)))
+         except ValueError, err:
+            logging.debug("%s, Newzbin will check it." % err)
+            inset = [e for e in self._episodes() if e.show in ruleset['shows']]
+            searches.append(search_newzbin(inset, rdict))
       
-      searches = defer.DeferredList(dfrds)
-      searches.addCallback(_enqueue_new_stuff)
+      eps = [e for e in self._episodes()
+             if [shows for shows, m in sets if e.show in shows]]
+      
+      posts = {}
+      searched = search_newzbin(eps, defaults['rules'], posts, _accepts)
+      searched.addCallback(_match)
+      return defer.DeferredList(searches + [searched])
+   
+   def put_on_probation(self, ep):
+      "Have ep enqueued once its probation (see Episode.was_fake) is over."
+      heapq.heappush(self._probation, (ep.probation, ep.show, ep.number, ep))
+      self.schedule_probation()
+   
+   def schedule_probation(self):
+      """
+      All probationary episodes share one reactor timer, set for whichever
+      one is due first. Their due times are saved along with everything else,
+      so call this after load() to pick up where we left off.
+      """
+      if self._probation_timer and self._probation_timer.active():
+         self._probation_timer.cancel()
+      self._probation_timer = None
+      
+      if self._probation:
+         wait = max(0, self._probation[0][0] - time.time())
+         self._probation_timer = reactor.callLater(wait, self._probation_over)
+   
+   def _probation_over(self):
+      self._probation_timer = None
+      now = time.time()
+      ready = []
+      while self._probation and self._probation[0][0] <= now:
+         due, show, number, ep = heapq.heappop(self._probation)
+         if self._byrageid.get(ep.tvrageid) is ep and ep.wanted == 'later' \
+               and ep.probation == due:
+            ep.probation = None
+            ep.wanted = True
+            ready.append(ep)
+      
+      self.schedule_probation()
+      enqueued = enqueue_episodes(ready)
+      enqueued.addCallback(lambda _: self.save())
+   
+   def poll_tvrage(self, sets, firstrun=False):
+      """
+      refresh() the Shows that are due: those that had an episode air
+      tvrage-slack minutes ago, so we hear about their next episode soon, and
+      those we haven't asked about in tvrage-interval minutes, oldest first.
+      At most tvrage-max-shows of them are asked about at a time, the rest
+      wait for the next call. The first call also follow()s sets, in case
+      they changed while we weren't running.
+      """
+      if firstrun:
+         return self.refresh(sets, firstrun)
+      
+      if not self._following:
+         self._following = True
+         followed = self.follow(sets)
+         followed.addCallback(lambda _: self.poll_tvrage(sets))
+         return followed
+      
+      now = time.time()
+      slack = 60 * config['tvrage-slack']
+      while self._upcoming and self._upcoming[0][0] + slack <= now:
+         self._due.add(heapq.heappop(self._upcoming)[1])
+      
+      stale = now - 60 * config['tvrage-interval']
+      shows = [s for s in self.shows if s.title in self._due
+                                        or s.fetched <= stale]
+      shows.sort(key=lambda s: (s.title not in self._due, s.fetched))
+      if config['tvrage-max-shows'] > 0:
+         shows = shows[:config['tvrage-max-shows']]
+      
+      self._due.difference_update(s.title for s in shows)
+      return self.refresh(sets, only=shows)
    
-   def unwant(self, floamid):
+   def tvrage_delay(self):
+      "Seconds until poll_tvrage() has something to do."
+      if self._upcoming is None:
+         self._build_airtimes()
+      
+      now = time.time()
+      oldest = min([s.fetched for s in self.shows] or [now])
+      wait = oldest + 60 * config['tvrage-interval'] - now
+      if self._due:
+         wait = 0
+      elif self._upcoming:
+         aired = self._upcoming[0][0] + 60 * config['tvrage-slack'] - now
+         wait = min(wait, aired)
+      return max(60, wait)
+   
+   def newzbin_delay(self):
+      """
+      Seconds until we should look_on_newzbin() again. While a wanted episode
+      aired within the last newzbin-window hours, that's newzbin-interval
+      minutes. Otherwise we wait twice as long each time, up to
+      newzbin-max-interval minutes, but never past the next airtime of a
+      wanted episode.
+      """
+      if self._airings is None:
+         self._build_airtimes()
+      
+      now = time.time()
+      base = 60 * config['newzbin-interval']
+      window = 60 * 60 * config['newzbin-window']
+      while self._airings:
+         airs, tvrageid = self._airings[0]
+         ep = self._byrageid.get(tvrageid)
+         if airs > now - window and ep and ep.wanted:
+            break
+         heapq.heappop(self._airings)
+      
+      if self._airings and self._airings[0][0] <= now:
+         self._idle = 0
+         return base
+      
+      self._idle += 1
+      wait = min(base * 2 ** self._idle, 60 * config['newzbin-max-interval'])
+      if self._airings:
+         wait = min(wait, max(base, self._airings[0][0] - now))
+      return wait
+   
+   def unwant(self, floamid, _save=True):
       """
       Given a humanize()'d ID for an episode, set the episode not to enqueue
       when it becomes available. 'aired' will unwant all aired episodes.
       """
       if floamid == 'aired':
-         out = ''
-         for ep in self._episodes():
-            if ep.wanted and ep.airs and ep.airs < dt.now(pytz.utc):
-               out += self.unwant(humanize(ep.tvrageid)) + "\n"
-         
-         return out
+         aired = [i for i in self.matching(aired_before=time.time())
+                  if self[i].wanted]
+         return ''.join(out + "\n" for out in self.unwant_many(aired))
       
       try:      
          if self[floamid].wanted:
             self[floamid].wanted = False
             self[floamid].newzbinid = None
-            self.save()
+            self[floamid].probation = None
+            changelog.record('unwanted', self[floamid])
+            if _save: self.save()
             return "Will not download %s when available." % self[floamid]
          else:
             return "Error: %s is already unwanted" % self[floamid]
       except KeyError:
          return "Error: %s is not a valid id." % floamid
    
-   def rewant(self, floamid):
+   def rewant(self, floamid, _save=True):
       """
       Given a humanize()'d ID for an episode, set the episode to enqueue when it
       becomes available.
@@ -235,37 +574,302 @@ class Collection(yaml.YAMLObject, xmlrpc.XMLRPC):
          if not self[floamid].wanted:
             self[floamid].wanted = True
             self[floamid].newzbinid = None
-            self.save()
+            changelog.record('wanted', self[floamid])
+            if _save: self.save()
             return "Will download %s when available." % self[floamid]
          else:
             return "Error: %s is already wanted" % self[floamid]
       except KeyError:
          return "Error: %s is not a valid id." % floamid
-         
+   
+   def unwant_many(self, floamids):
+      "unwant() each of floamids and save once. Returns what each one said."
+      out = [self.unwant(floamid, _save=False) for floamid in floamids]
+      self.save()
+      return out
+   
+   def rewant_many(self, floamids):
+      "rewant() each of floamids and save once. Returns what each one said."
+      out = [self.rewant(floamid, _save=False) for floamid in floamids]
+      self.save()
+      return out
+   
+   def matching(self, show=None, aired_before=None):
+      """
+      humanize()'d IDs of the episodes of show, or of every show, that aired
+      before aired_before (seconds since the epoch) if it's given.
+      """
+      return [humanize(e.tvrageid) for s in self.shows
+              if show is None or s.title == show for e in s.episodes
+              if aired_before is None
+              or e.airtime is not None and e.airtime < aired_before]
+   
+   def _matching(self, criteria):
+      """
+      matching() for XML-RPC, which has no None. criteria is a struct with
+      'show' and/or 'aired-before', see _when().
+      """
+      return self.matching(criteria.get('show'),
+                           self._when(criteria.get('aired-before')))
+   
+   def _when(self, when):
+      "An XML-RPC time, seconds since the epoch or a YYYY-MM-DD date, UTC."
+      if isinstance(when, basestring):
+         return to_epoch(dt.strptime(when, "%Y-%m-%d"))
+      return when
+   
    def save(self):
       """
-      Write the entire Collection to disk (at global dbpath) in YAML format.
+      Persist the Collection. Saves asked for within save-delay seconds of
+      each other are written together by a worker thread, see _write(), and
+      the returned Deferred fires once they're on disk. Without a running
+      reactor everything is written right away.
       """
-      with open(dbpath + '~', 'w') as savefile:
-         yaml.dump(self, savefile, indent=4, default_flow_style=False)
+      if not reactor.running:
+         self.flush()
+         return defer.succeed(None)
       
-      shutil.move(dbpath + '~', dbpath)
+      saved = defer.Deferred()
+      self._waiting.append(saved)
+      if not (self._save_call or self._writing):
+         self._save_call = reactor.callLater(config['save-delay'], self._write)
+      return saved
+   
+   def flush(self):
+      "Write whatever save() hasn't yet, right now, without a worker thread."
+      if self._save_call and self._save_call.active():
+         self._save_call.cancel()
+      self._save_call = None
+      waiting, self._waiting = self._waiting, []
+      
+      work = self._changes()
+      if work:
+         kind, write, data = work
+         start = time.time()
+         if write(data):
+            self.snapshot()
+         metrics.observe('floamtv_%s_seconds' % kind, time.time() - start)
+      
+      for saved in waiting:
+         saved.callback(None)
+   
+   def snapshot(self):
+      "Write the entire Collection to storage right away."
+      start = time.time()
+      self._persisted = self._state()
+      storage().replace(self._dump())
+      metrics.observe('floamtv_snapshot_seconds', time.time() - start)
+   
+   def _changes(self):
+      """
+      What save() needs to write, as (kind, writer, data) or None if nothing
+      changed. Changes to episodes since the last save are appended to
+      storage (see FileStorage and SQLiteStorage) as (show, number, what)
+      records: what is a dict of the journaled attributes that changed, the
+      fields of a new episode as Episode.fields() gives them, or None for an
+      episode that's gone. A show that was fetched since gets a (show, None,
+      {'fetched': fetched}) record. If shows came or went since, or storage
+      asked to be compacted, the whole Collection is written instead. data
+      is plain tuples, so the writer can take its time with it in another
+      thread.
+      """
+      shows, state = self._state()
+      if self._compact or self._persisted is None \
+            or set(shows) != set(self._persisted[0]):
+         self._compact = False
+         self._persisted = shows, state
+         return 'snapshot', storage().replace, self._dump()
+      
+      fetched, persisted = self._persisted
+      records = [(title, None, { 'fetched': shows[title] })
+                 for title in shows if shows[title] != fetched[title]]
+      for e in self._episodes():
+         key = (e.show, e.number)
+         now, was = state[key], persisted.get(key)
+         if was is None:
+            records.append(key + (e.fields(),))
+         elif now != was:
+            changes = dict((field, new) for field, new, old
+                           in zip(self.journaled, now, was) if new != old)
+            records.append(key + (changes,))
+      records.extend(key + (None,) for key in persisted if key not in state)
+      
+      self._persisted = shows, state
+      if records:
+         return 'save', storage().append, records
+   
+   def _write(self):
+      """
+      Works out what changed on the reactor thread, which is cheap, and has a
+      worker thread do the slow part of writing it out. Only one write is in
+      flight at a time, saves asked for meanwhile wait for the next one.
+      """
+      def _written(compact, start):
+         metrics.observe('floamtv_%s_seconds' % kind, time.time() - start)
+         if compact:
+            self._compact = True
+            self.save()
+      
+      def _failed(err):
+         logging.error("Couldn't save: %s" % err.getErrorMessage())
+         self._persisted = None
+      
+      def _done(_):
+         self._writing = None
+         if self._waiting and not self._save_call:
+            self._save_call = reactor.callLater(0, self._write)
+         for saved in waiting:
+            saved.callback(None)
+      
+      self._save_call = None
+      waiting, self._waiting = self._waiting, []
+      work = self._changes()
+      if not work:
+         return _done(None)
+      
+      kind, write, data = work
+      self._writing = threads.deferToThread(write, data)
+      self._writing.addCallbacks(_written, _failed, (time.time(),))
+      self._writing.addBoth(_done)
+   
+   def _build_airtimes(self):
+      "Sort out upcoming airtimes for tvrage_delay() and newzbin_delay()."
+      now = time.time()
+      window = 60 * 60 * config['newzbin-window']
+      self._upcoming = []
+      self._airings = []
+      
+      for e in self._episodes():
+         airs = e.airtime
+         if airs is None:
+            continue
+         if airs > now:
+            self._upcoming.append((airs, e.show))
+         if e.wanted and airs > now - window:
+            self._airings.append((airs, e.tvrageid))
+      
+      heapq.heapify(self._upcoming)
+      heapq.heapify(self._airings)
+   
+   def _dump(self):
+      "The Collection as plain tuples of builtin types, for marshal."
+      return [(s.title, s.timezone, [e.fields() for e in s.episodes],
+               s.fetched) for s in self.shows]
+   
+   def _state(self):
+      """
+      When each show was fetched keyed by its title, and the journaled
+      attributes of every episode keyed by (show, number).
+      """
+      return (dict((s.title, s.fetched) for s in self.shows),
+              dict(((e.show, e.number),
+                    (e.wanted, e.newzbinid, e.airtime, e.title,
+                     e.probation, e.tvrageid))
+                   for e in self._episodes()))
    
    def _episodes(self):
       for show in self.shows:
          for episode in show.episodes:
             yield episode
    
+   def _index(self, ep):
+      self._byfloamid[humanize(ep.tvrageid)] = ep
+      self._byrageid[ep.tvrageid] = ep
+   
+   def _unindex(self, ep):
+      if self._byrageid.get(ep.tvrageid) is ep:
+         del self._byrageid[ep.tvrageid]
+         del self._byfloamid[humanize(ep.tvrageid)]
+   
+   def _reindex(self):
+      """
+      Rebuild the episode index and the probation queue from scratch, after
+      loading for instance.
+      """
+      self._byfloamid = {}
+      self._byrageid = {}
+      self._probation = []
+      for show in self.shows:
+         show.collection = self
+         for episode in show.episodes:
+            self._index(episode)
+            if episode.wanted == 'later' and episode.probation is None:
+               episode.wanted = True
+            elif episode.probation is not None:
+               self._probation.append((episode.probation, episode.show,
+                                       episode.number, episode))
+      
+      heapq.heapify(self._probation)
+   
    def __getitem__(self, item):
-      for episode in self._episodes():
-         if humanize(episode.tvrageid) == item:
-            return episode
-      else:
+      try:
+         return self._byfloamid[item]
+      except KeyError:
          raise KeyError, "No episode with id %s" % item
    
+   def __getstate__(self):
+      return { 'shows': self.shows }
+   
+   def __setstate__(self, state):
+      self.__dict__.update(state)
+      self._waiting = []
+      self._due = set()
+   
+   def counts(self):
+      "How many episodes we have in each state, for metrics."
+      counts = defaultdict(int)
+      names = { True: 'wanted', False: 'unwanted' }
+      for e in self._episodes():
+         counts[names.get(e.wanted, e.wanted)] += 1
+      return [({ 'state': state }, n) for state, n in counts.iteritems()]
+   
    xmlrpc_status = status
    xmlrpc_unwant = unwant
    xmlrpc_rewant = rewant
+   xmlrpc_unwant_many = unwant_many
+   xmlrpc_rewant_many = rewant_many
+   
+   def xmlrpc_unwant_matching(self, criteria):
+      return self.unwant_many(self._matching(criteria))
+   
+   def xmlrpc_rewant_matching(self, criteria):
+      return self.rewant_many(self._matching(criteria))
+   
+   def xmlrpc_episodes(self, criteria=None, offset=0, limit=0):
+      """
+      episodes() for XML-RPC. criteria is a struct with any of 'wanted',
+      'show', 'aired-after' and 'aired-before', see _when(). A limit of 0
+      means no limit. Unknown airtimes and Newzbin IDs come back as 0.
+      """
+      criteria = criteria or {}
+      rows = self.episodes(criteria.get('wanted'), criteria.get('show'),
+                           self._when(criteria.get('aired-after')),
+                           self._when(criteria.get('aired-before')),
+                           offset, limit or None)
+      return [r[:4] + (r[4] or 0, r[5], r[6] or 0) for r in rows]
+   
+   def xmlrpc_changes_since(self, version):
+      "changelog.since() over XML-RPC, a long poll for what's changed."
+      return changelog.since(version)
+   
+   def xmlrpc_metrics(self):
+      return metrics.as_dict()
+   
+   def xmlrpc_profile(self, on=None):
+      "Turns the Profiler on or off, or the other way around if on isn't given."
+      if on is None:
+         on = not profiler.running
+      if on:
+         profiler.start()
+         return "Profiling into %s." % profiler.directory()
+      profiler.stop()
+      return "Not profiling."
+   
+   def lookupProcedure(self, path):
+      f = xmlrpc.XMLRPC.lookupProcedure(self, path)
+      if profiler.running and path != 'changes_since':
+         return lambda *a: profiler.call('xmlrpc-' + path, f, *a)
+      return f
 
 class Show(yaml.YAMLObject):
    """
@@ -275,10 +879,23 @@ class Show(yaml.YAMLObject):
    """
    
    yaml_tag = '!Show'
+   __slots__ = ('title', 'timezone', 'episodes', 'collection', 'fetched')
+   
    def __init__(self, title, timezone):
       self.episodes = []
-      self.title = title
+      self.title = interned(title)
       self.timezone = timezone
+      self.collection = None
+      self.fetched = 0
+   
+   def __getstate__(self):
+      return { 'title': self.title, 'timezone': self.timezone,
+               'episodes': self.episodes, 'fetched': self.fetched }
+   
+   def __setstate__(self, state):
+      self.__init__(state['title'], state['timezone'])
+      self.episodes = state['episodes']
+      self.fetched = state.get('fetched', 0)
       
    def _add_episode(self, info):
       "Given a dict with TVRage info, create a new Episode in self.episodes"
@@ -292,15 +909,20 @@ class Show(yaml.YAMLObject):
             attrs = ['title', 'airs', 'tvrageid']
             pert = lambda ep: [getattr(ep, attr) for attr in attrs]
             if ep and gotit and pert(ep) != pert(gotit):
+               if self.collection: self.collection._unindex(gotit)
                gotit.title = ep.title
                gotit.airs = ep.airs
                gotit.tvrageid = ep.tvrageid
+               if self.collection: self.collection._index(gotit)
                logging.info("Updated episode: %s" % gotit)
+               changelog.record('updated', gotit)
             break
          
          else:
             self.episodes.append(ep)
+            if self.collection: self.collection._index(ep)
             logging.info("New episode: %s" % ep)
+            changelog.record('new', ep)
 
    def add(self, episode):
       """
@@ -318,14 +940,36 @@ class Show(yaml.YAMLObject):
    def update(self, rageinfo):
       """
       Given a dict with TVRage information on this show, try to add both the
-      latest episode and the upcoming episode to this Show.
+      latest episode and the upcoming episode to this Show. Episodes we
+      already have that still air on the same day aren't looked up again.
       """
       rcnt = filter(bool, [rageinfo['latest'], rageinfo['next']])
-      cbs = [self.add(ep) for ep in rcnt]
-      self.episodes = [e for e in self.episodes if e.number in rcnt or e.wanted
-                       or len(rcnt) < 2]
+      airdates = rageinfo.get('airdates') or {}
+      cbs = [self.add(ep) for ep in rcnt
+             if not self._unchanged(ep, airdates.get(ep))]
+      keep = lambda e: e.number in rcnt or e.wanted or len(rcnt) < 2
+      if self.collection:
+         for e in self.episodes:
+            if not keep(e): self.collection._unindex(e)
+      self.episodes = filter(keep, self.episodes)
       return defer.DeferredList([dfrd for dfrd in cbs if dfrd])
    
+   def _unchanged(self, number, airdate):
+      """
+      True if we have episode number already, and airdate (as in TVRage's
+      'Jan/05/2008') is the day it airs here.
+      """
+      for e in self.episodes:
+         if e.number == number:
+            if e.airs is None or not airdate:
+               return False
+            try:
+               day = dt.strptime(airdate, "%b/%d/%Y").date()
+            except ValueError:
+               return False
+            return e.airs.astimezone(pytz.timezone(self.timezone)).date() == day
+      return False
+   
    def __repr__(self):
       return "<Show %s with episodes %s>" \
          % (self.title, (' and ').join(map(str, self.episodes)))
@@ -343,87 +987,105 @@ class Episode(yaml.YAMLObject):
     tvrageid: Integer ID number used by TVRage to identify an episode.
     airs:     datetime.datetime() or None if unknown airtime.
     number:   Something like '3x05', season 3 episode 5.
+   
+   There are a lot of these, so they're kept small: the show title is shared
+   with every other Episode of the show, the number is kept as a (season,
+   episode) pair of ints and airs as airtime, seconds since the epoch, UTC.
    """
    
    yaml_tag = '!Episode'
+   __slots__ = ('show', '_number', 'title', 'tvrageid', 'airtime',
+                'newzbinid', 'wanted', 'probation')
+   
    def __init__(self, wecallit, number, title, tvrageid, airs, *a, **kw):
-      self.show = wecallit
+      self.show = interned(wecallit)
       self.number = number
       self.title = title
       self.tvrageid = tvrageid
       self.airs = airs
       self.newzbinid = None
       self.wanted = True
+      self.probation = None
    
-   def enqueue(self, allow_probation=False):
-      """
-      Enqueue episodes that have a Newzbin ID resolved with Hellanzb. If
-      allow_probation is True, don't exclude shows that are on probation.
-      """
-      
-      def _handle_sab(result, ep):
-         if 'error' in result:
-            logging.error("Unable to enqueue %s" % ep)
-            logging.error("Reason: %s" % result)
-         else:
-            logging.info("Enqueued %s" % ep)
-            ep.wanted = False
-      
-      def _handle_sab_fail(err, ep):
-         logging.error("Unable to enqueue %s" % ep)
-      
-      if self.newzbinid and self.wanted != 'later' or allow_probation:
-         if 'sab' in config['nzbclient']:
-            url = urlencode({'mode': 'addid',
-                             'name': self.newzbinid,
-                             'apikey': config['sabnzbd-apikey']})
-
-            url = "http://%s:%s/sabnzbd/api?%s" % (config['sabnzbd-host'],
-                                                   config['sabnzbd-port'], 
-                                                   url)
-            
-            attempt = getPage(url, timeout=60)
-            attempt.addCallback(_handle_sab, self)
-            attempt.addErrback(_handle_sab_fail, self)
-            
-         
-         else:
-            try:
-               hella = ServerProxy("http://hellanzb:%s@%s:8760"
-                           % (config['hellanzb-pass'], config['hellanzb-host']))
-               hella.enqueuenewzbin(self.newzbinid)
-         
-            except:
-               logging.error("Unable to enqueue %s" % self)
-               return False
-         
-            else:
-               logging.info("Enqueued %s" % self)
-               self.wanted = False
-            
+   def _get_number(self):
+      if self._number.__class__ is tuple:
+         return '%02dx%02d' % self._number
+      return self._number
    
-   def educate(self):
-      """
-      After loading data from YAML, the datetimes will be naive.
-      """
+   def _set_number(self, number):
+      "Numbers that don't look like TVRage's usual '03x05' are kept as is."
       try:
-         self.airs = pytz.utc.localize(self.airs)
-      except (AttributeError, ValueError):
-         return
-      
+         season, episode = map(int, number.split('x'))
+      except (ValueError, AttributeError):
+         self._number = number
+      else:
+         if '%02dx%02d' % (season, episode) == number:
+            self._number = (season, episode)
+         else:
+            self._number = number
+   
+   number = property(_get_number, _set_number)
+   
+   def _get_airs(self):
+      return from_epoch(self.airtime)
+   
+   def _set_airs(self, airs):
+      "Naive datetimes, as YAML gives us, are taken to be UTC."
+      self.airtime = to_epoch(airs)
+   
+   airs = property(_get_airs, _set_airs)
+   
+   def __getstate__(self):
+      airs = self.airs and self.airs.replace(tzinfo=None)
+      return { 'show': self.show, 'number': self.number, 'title': self.title,
+               'tvrageid': self.tvrageid, 'airs': airs,
+               'newzbinid': self.newzbinid, 'wanted': self.wanted,
+               'probation': self.probation }
+   
+   def fields(self):
+      "The Episode as the plain tuple snapshots and storage keep."
+      return (self.number, self.title, self.tvrageid, self.airtime,
+              self.newzbinid, self.wanted, self.probation)
+   
+   def from_fields(cls, show, fields):
+      "Makes an Episode of show back out of fields()."
+      number, title, tvrageid, airtime, newzbinid, wanted, probation = fields
+      ep = cls(show, number, title, tvrageid, None)
+      ep.airtime = airtime
+      ep.newzbinid = newzbinid
+      ep.wanted = wanted
+      ep.probation = probation
+      return ep
+   
+   from_fields = classmethod(from_fields)
+   
+   def __setstate__(self, state):
+      self.__init__(state['show'], state['number'], state['title'],
+                    state['tvrageid'], state['airs'])
+      self.newzbinid = state.get('newzbinid')
+      self.wanted = state.get('wanted', True)
+      self.probation = state.get('probation')
+   
+   def may_enqueue(self, allow_probation=False):
+      return self.newzbinid and self.wanted != 'later' or allow_probation
+   
    def was_fake(self, sure=True):
       """
       Call this if we find out a newzbinid for a show is actually pointing at a
       fake post. It'll be put to the same state it was at before we found a
       newzbinid for it. Call with sure = False if the post is suspect prior to
       downloading -- this will put it on 'probation' for a couple hours and only
-      download it if it isn't deleted from Newzbin in the interim.
+      download it if it isn't deleted from Newzbin in the interim. Returns True
+      if it did, self.probation is then when the probation is over, and the
+      Collection takes care of enqueueing it at that time.
       """
       if self.wanted != 'later':
          if sure:
             logging.warning("%s was fake. Requeueing." % self)
             self.newzbinid = None
             self.wanted = True
+            self.probation = None
+            changelog.record('fake', self)
          elif self.wanted:
             self.wanted = 'later'
             later = min(timedelta(hours=2), self.airs-dt.now(pytz.utc))
@@ -431,7 +1093,9 @@ class Episode(yaml.YAMLObject):
             
             logging.warning("%s is too early. Will try again at %s." % (self,
                                                                      latertime))
-            reactor.callLater(later.seconds, self.enqueue, True)
+            self.probation = to_epoch(dt.now(pytz.utc) + later)
+            changelog.record('probation', self)
+            return True
    
    def __repr__(self):
       return "<Episode %s - %s - %s>" \
@@ -442,6 +1106,756 @@ class Episode(yaml.YAMLObject):
                                      humanize(self.tvrageid))
       
 
+if hasattr(yaml, 'CLoader'):
+   for cls in (Collection, Show, Episode):
+      yaml.CLoader.add_constructor(cls.yaml_tag, cls.from_yaml)
+
+class Poller(object):
+   """
+   Like task.LoopingCall, but rather than sticking to one interval it asks
+   delay() how many seconds to wait once each call of f (and any Deferred it
+   returned) is done.
+   """
+   
+   running = False
+   
+   def __init__(self, delay, f, *a, **kw):
+      self.delay = delay
+      self.f, self.a, self.kw = f, a, kw
+      self.call = None
+   
+   def start(self, now=True):
+      self.running = True
+      if now:
+         self._run()
+      else:
+         self._schedule()
+   
+   def stop(self):
+      self.running = False
+      if self.call and self.call.active():
+         self.call.cancel()
+      self.call = None
+   
+   def reschedule(self):
+      "Asks delay() again, if we're waiting for the next call."
+      if self.call and self.call.active():
+         self.call.cancel()
+         self.call = None
+         self._schedule()
+   
+   def _run(self):
+      self.call = None
+      d = profiler.call(self.f.__name__, self.f, *self.a, **self.kw)
+      metrics.timed(d, 'floamtv_cycle_seconds', cycle=self.f.__name__)
+      d.addErrback(log.err)
+      d.addCallback(lambda _: self._schedule())
+   
+   def _schedule(self):
+      if self.running and not self.call:
+         wait = self.delay()
+         logging.debug("Next %s in %d minutes." % (self.f.__name__, wait / 60))
+         self.call = reactor.callLater(wait, self._run)
+
+class BodyLines(protocol.Protocol):
+   """
+   Hands a response body to online() as lists of complete lines as soon as
+   they arrive, without ever holding on to the whole body. finished fires
+   once the body is over. Cancelling finished drops the connection, and
+   nothing more is handed to online().
+   """
+   
+   def __init__(self, online):
+      self.online = online
+      self.finished = defer.Deferred(self._cancel)
+      self.rest = ''
+   
+   def dataReceived(self, data):
+      if self.finished.called:
+         return
+      lines = (self.rest + data).split('\n')
+      self.rest = lines.pop()
+      if lines:
+         self.online(lines)
+   
+   def connectionLost(self, reason):
+      if self.finished.called:
+         return
+      if self.rest:
+         self.online([self.rest])
+      if reason.check(ResponseDone, PotentialDataLoss):
+         self.finished.callback(None)
+      else:
+         self.finished.errback(reason)
+   
+   def _cancel(self, finished):
+      abort = getattr(self.transport, 'abortConnection', None)
+      if abort:
+         abort()
+      else:
+         self.transport.stopProducing()
+
+if HTTPConnectionPool:
+   class CountingPool(HTTPConnectionPool):
+      "An HTTPConnectionPool that counts how often it had to connect afresh."
+      requests = connects = 0
+      
+      def getConnection(self, key, endpoint):
+         self.requests += 1
+         return HTTPConnectionPool.getConnection(self, key, endpoint)
+      
+      def _newConnection(self, key, endpoint):
+         self.connects += 1
+         return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+class Scheduler(object):
+   """
+   Every HTTP request we make goes through fetch(). Each host gets at most
+   max-connections requests in flight at once and a token bucket that refills
+   at requests-per-minute and holds up to max-connections tokens, so short
+   bursts are fine but sustained hammering is not. Both can be overridden per
+   host in the config under 'hosts'. SABnzbd, which takes one Newzbin ID per
+   request, starts out with sab-max-connections and sab-requests-per-minute
+   instead. Requests waiting for their turn go out
+   by priority (ENQUEUE, then SEARCH, then REFRESH), oldest first.
+   """
+   
+   def __init__(self):
+      self.hosts = {}
+      self.seq = 0
+   
+   def fetch(self, url, priority, **kw):
+      "Takes the same arguments as getPage(), plus a priority."
+      host = self._host(urlparse.urlsplit(url)[1])
+      self.seq += 1
+      d = defer.Deferred()
+      heapq.heappush(host['queue'], (priority, self.seq, d, url, kw))
+      self._pump(host)
+      return d
+   
+   def stats(self):
+      return dict((name, { 'queued': len(h['queue']), 'active': h['active'] })
+                  for name, h in self.hosts.iteritems())
+   
+   def _host(self, name):
+      if name not in self.hosts:
+         bare = name.split(':')[0]
+         limits = {}
+         if bare == config['sabnzbd-host']:
+            limits = { 'max-connections': config['sab-max-connections'],
+                       'requests-per-minute':
+                          config['sab-requests-per-minute'] }
+         limits.update(config['hosts'].get(bare) or {})
+         conns = int(limits.get('max-connections', config['max-connections']))
+         rpm = float(limits.get('requests-per-minute',
+                                config['requests-per-minute']))
+         self.hosts[name] = { 'name': name, 'queue': [], 'active': 0,
+                              'wakeup': None,
+                              'connections': max(1, conns),
+                              'rate': max(rpm, 1) / 60, 'tokens': max(1, conns),
+                              'stamp': time.time() }
+      return self.hosts[name]
+   
+   def _pump(self, host):
+      now = time.time()
+      refill = (now - host['stamp']) * host['rate']
+      host['tokens'] = min(host['connections'], host['tokens'] + refill)
+      host['stamp'] = now
+      
+      while host['queue'] and host['active'] < host['connections'] \
+            and host['tokens'] >= 1:
+         host['tokens'] -= 1
+         host['active'] += 1
+         priority, seq, d, url, kw = heapq.heappop(host['queue'])
+         page = get_page(url, **kw)
+         metrics.timed(page, 'floamtv_request_seconds', host=host['name'])
+         page.addBoth(self._done, host)
+         page.chainDeferred(d)
+      
+      waiting = host['wakeup'] and host['wakeup'].active()
+      if host['queue'] and host['active'] < host['connections'] and not waiting:
+         delay = (1 - host['tokens']) / host['rate']
+         host['wakeup'] = reactor.callLater(delay, self._pump, host)
+   
+   def _done(self, result, host):
+      host['active'] -= 1
+      if isinstance(result, failure.Failure):
+         metrics.count('floamtv_request_errors_total', host=host['name'])
+      self._pump(host)
+      return result
+
+class SabQueue(object):
+   """
+   Newzbin IDs on their way to SABnzbd. submit() returns a Deferred that
+   fires with True if SABnzbd took the ID. An ID that is already on its way
+   isn't sent again, everyone who submitted it gets the same answer. When
+   SABnzbd can't be reached we try again after sab-retry seconds, doubling
+   the wait each time, up to sab-retries times.
+   """
+   
+   def __init__(self):
+      self.inflight = {}
+   
+   def submit(self, newzbinid):
+      waiting = defer.Deferred()
+      if newzbinid in self.inflight:
+         self.inflight[newzbinid].append(waiting)
+      else:
+         self.inflight[newzbinid] = [waiting]
+         self._send(newzbinid, 0)
+      return waiting
+   
+   def _send(self, newzbinid, tries):
+      url = urlencode({'mode': 'addid',
+                       'name': newzbinid,
+                       'apikey': config['sabnzbd-apikey']})
+      
+      url = "http://%s:%s/sabnzbd/api?%s" % (config['sabnzbd-host'],
+                                             config['sabnzbd-port'], 
+                                             url)
+      
+      attempt = scheduler.fetch(url, ENQUEUE, timeout=60)
+      attempt.addCallbacks(self._answered, self._failed,
+                           (newzbinid,), None, (newzbinid, tries))
+   
+   def _answered(self, result, newzbinid):
+      if 'error' in result:
+         logging.error("SABnzbd refused %s: %s" % (newzbinid, result.strip()))
+      self._finish(newzbinid, 'error' not in result)
+   
+   def _failed(self, err, newzbinid, tries):
+      if tries < config['sab-retries']:
+         delay = config['sab-retry'] * 2 ** tries
+         logging.warning("Couldn't reach SABnzbd (%s), trying again in %d "
+                         "seconds." % (err.getErrorMessage(), delay))
+         reactor.callLater(delay, self._send, newzbinid, tries + 1)
+      else:
+         self._finish(newzbinid, False)
+   
+   def _finish(self, newzbinid, took):
+      for waiting in self.inflight.pop(newzbinid):
+         waiting.callback(took)
+
+class TimeoutTransport(Transport):
+   "An xmlrpclib Transport whose connections give up after timeout seconds."
+   
+   def __init__(self, timeout):
+      Transport.__init__(self)
+      self.timeout = timeout
+   
+   def make_connection(self, host):
+      conn = Transport.make_connection(self, host)
+      getattr(conn, '_conn', conn).timeout = self.timeout
+      return conn
+
+class TVRageCache(object):
+   """
+   Remembers what parse_tvrage() made of TVRage's answers, keyed by the
+   (show, episode) pair tvrage_info() was called with. Episodes that have
+   already aired hardly ever change and are kept for cache-aired-ttl hours,
+   everything else for cache-ttl minutes. Past cache-size entries the least
+   recently used ones are dropped. The cache lives at global cachepath.
+   """
+   
+   def __init__(self):
+      self.entries = None
+      self.clock = 0
+      self.synced = time.time()
+      self.hits = self.misses = self.evictions = 0
+   
+   def get(self, key):
+      "Returns a fresh copy of the cached info for key, or None."
+      entry = self._entries().get(key)
+      if entry and entry[0] > time.time():
+         self.hits += 1
+         self.clock += 1
+         entry[1] = self.clock
+         info = dict(entry[2])
+         if info.get('airs') is not None:
+            info['airs'] = dt.utcfromtimestamp(info['airs'])
+         return info
+      
+      self.misses += 1
+   
+   def store(self, info, key):
+      "Callback for tvrage_info(), caches info and passes it along."
+      if key[1] and info.get('airs') and info['airs'] < dt.now() - timedelta(1):
+         ttl = config['cache-aired-ttl'] * 60 * 60
+      else:
+         ttl = config['cache-ttl'] * 60
+      
+      frozen = dict(info)
+      if info.get('airs') is not None:
+         frozen['airs'] = to_epoch(info['airs'])
+      self.clock += 1
+      self._entries()[key] = [time.time() + ttl, self.clock, frozen]
+      
+      overflow = len(self.entries) - config['cache-size']
+      if overflow > 0:
+         overflow += config['cache-size'] / 10
+         byage = sorted(self.entries, key=lambda k: self.entries[k][1])
+         for old in byage[:overflow]:
+            del self.entries[old]
+         self.evictions += overflow
+      
+      return info
+   
+   def stats(self):
+      return { 'hits': self.hits, 'misses': self.misses,
+               'evictions': self.evictions, 'size': len(self._entries()) }
+   
+   def sync(self):
+      "Write unexpired entries to disk."
+      now = time.time()
+      alive = dict((k, v) for k, v in self._entries().iteritems() if v[0] > now)
+      with open(cachepath + '~', 'wb') as cachefile:
+         marshal.dump(alive, cachefile)
+      shutil.move(cachepath + '~', cachepath)
+      self.synced = now
+      
+      logging.info("TVRage cache: %(hits)d hits, %(misses)d misses, "
+                   "%(evictions)d evicted, %(size)d entries." % self.stats())
+   
+   def _entries(self):
+      if self.entries is None:
+         try:
+            with open(cachepath, 'rb') as cachefile:
+               self.entries = marshal.load(cachefile)
+         except (IOError, EOFError, ValueError, TypeError):
+            self.entries = {}
+         self.clock = max([e[1] for e in self.entries.values()] or [0])
+      
+      return self.entries
+
+class FileStorage(object):
+   """
+   Keeps the Collection as a snapshot at dbpath (see load_snapshot()) plus a
+   journal of the changes since at dbpath + '.journal'. Once the journal
+   passes journal-size KB, append() asks for it to be folded into a new
+   snapshot.
+   """
+   
+   def exists(self):
+      return os.path.exists(dbpath)
+   
+   def load(self):
+      """
+      Returns (Collection, current). Databases still in the old YAML format
+      are read with LibYAML when available, and aren't current: they get
+      rewritten as a snapshot the next time the Collection is saved.
+      """
+      with open(dbpath, 'rb') as savefile:
+         if savefile.read(len(snapshot_magic)) == snapshot_magic:
+            ss = load_snapshot(savefile)
+            current = True
+         else:
+            savefile.seek(0)
+            ss = yaml.load(savefile,
+                           Loader=getattr(yaml, 'CLoader', yaml.Loader))
+            current = False
+      
+      replay_journal(ss)
+      return ss, current
+   
+   def append(self, records):
+      with open(dbpath + '.journal', 'ab') as journal:
+         for record in records:
+            marshal.dump(record, journal)
+         return journal.tell() > config['journal-size'] * 1024
+   
+   def replace(self, shows):
+      with open(dbpath + '~', 'wb') as savefile:
+         savefile.write(snapshot_magic)
+         marshal.dump((snapshot_version, shows), savefile)
+      
+      shutil.move(dbpath + '~', dbpath)
+      if os.path.exists(dbpath + '.journal'):
+         os.unlink(dbpath + '.journal')
+
+class SQLiteStorage(object):
+   """
+   Keeps the Collection in an SQLite database at sqlitepath, a row per
+   episode. Each append() inserts, updates or deletes just the rows that
+   changed, by their (show, number) key, in one transaction. The daemon
+   keeps the whole Collection in memory and queries it there, so there are
+   no other indexes to keep up. Needs Python's sqlite3 module.
+   """
+   
+   schema = """
+      CREATE TABLE IF NOT EXISTS shows (title TEXT PRIMARY KEY, timezone TEXT,
+                                        fetched INTEGER);
+      CREATE TABLE IF NOT EXISTS episodes (
+         show TEXT, number TEXT, title TEXT, tvrageid INTEGER, airs INTEGER,
+         newzbinid INTEGER, wanted, probation INTEGER,
+         PRIMARY KEY (show, number));
+   """
+   
+   columns = ('number', 'title', 'tvrageid', 'airs', 'newzbinid', 'wanted',
+              'probation')
+   
+   def __init__(self):
+      self.db = None
+   
+   def exists(self):
+      return os.path.exists(sqlitepath)
+   
+   def load(self):
+      ss = Collection()
+      shows = {}
+      for title, timezone, fetched in self._db().execute(
+            "SELECT title, timezone, fetched FROM shows ORDER BY rowid"):
+         shows[title] = Show(title, timezone)
+         shows[title].fetched = fetched or 0
+         ss.shows.append(shows[title])
+      
+      for row in self._db().execute("SELECT show, %s FROM episodes ORDER BY "
+                                    "rowid" % ', '.join(self.columns)):
+         show = shows[row[0]]
+         ep = Episode.from_fields(show.title, row[1:])
+         ep.wanted = { 0: False, 1: True }.get(ep.wanted, ep.wanted)
+         show.episodes.append(ep)
+      
+      return ss, True
+   
+   def append(self, records):
+      def _updates():
+         for show, number, changes in records:
+            if number is None:
+               yield ("UPDATE shows SET fetched = ? WHERE title = ?",
+                      (changes['fetched'], show))
+            elif changes is None:
+               yield ("DELETE FROM episodes WHERE show = ? AND number = ?",
+                      (show, number))
+            elif isinstance(changes, tuple):
+               yield ("INSERT INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (show,) + changes)
+            else:
+               fields = sorted(changes)
+               yield ("UPDATE episodes SET %s WHERE show = ? AND number = ?"
+                      % ', '.join('%s = ?' % f for f in fields),
+                      [changes[f] for f in fields] + [show, number])
+      
+      self._transaction(_updates())
+   
+   def replace(self, shows):
+      def _rows():
+         yield "DELETE FROM episodes", ()
+         yield "DELETE FROM shows", ()
+         for title, timezone, episodes, fetched in shows:
+            yield "INSERT INTO shows VALUES (?, ?, ?)", (title, timezone,
+                                                         fetched)
+            for fields in episodes:
+               yield "INSERT INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", \
+                     (title,) + fields
+      
+      self._transaction(_rows())
+   
+   def _transaction(self, statements):
+      db = self._db()
+      try:
+         for sql, args in statements:
+            db.execute(sql, args)
+      except:
+         db.rollback()
+         raise
+      db.commit()
+   
+   def _db(self):
+      "Connects on first use. Saves use it from a worker thread, one at a time."
+      if self.db is None:
+         if sqlite3 is None:
+            raise ImportError, "storage: sqlite needs Python's sqlite3 module."
+         self.db = sqlite3.connect(sqlitepath, check_same_thread=False)
+         self.db.text_factory = str
+         self.db.executescript(self.schema)
+      return self.db
+
+class NewzbinResults(object):
+   """
+   Reads Newzbin's CSV feed a few lines at a time, picking out the newzbin
+   ID for each of the TVRage IDs we asked about. Results come newest first,
+   so the first row we see for a TVRage ID is the one we keep. If posts is
+   True, every row for each TVRage ID is also kept in posts, as
+   (newzbinid, megs, groups, title) read from the columns the config names.
+   """
+   
+   def __init__(self, tvrageids, posts=False):
+      self.wanted = set(tvrageids)
+      self.found = {}
+      self.rows = 0
+      self.posts = defaultdict(list) if posts else None
+   
+   def feed(self, lines):
+      for row in csv.reader(lines):
+         self.rows += 1
+         if len(row) < 5:
+            continue
+         
+         tvid = rageid_from_url(row[4])
+         if tvid in self.wanted and tvid not in self.found:
+            self.found[tvid] = int(row[1])
+         if tvid in self.wanted and self.posts is not None:
+            self.posts[tvid].append(self._post(row))
+   
+   def _post(self, row):
+      column = lambda n: n < len(row) and row[n] or ''
+      try:
+         megs = float(column(config['newzbin-size-column'])) / 1024 / 1024
+      except ValueError:
+         megs = None
+      groups = re.split(r'[\s,]+', column(config['newzbin-groups-column']))
+      return (int(row[1]), megs, frozenset(g for g in groups if g),
+              column(config['newzbin-title-column']))
+
+class Metrics(object):
+   """
+   Counters, gauges and latency histograms, served as a dict by the
+   metrics XML-RPC method and in Prometheus' text format at /metrics.
+   Labels are given as keyword arguments. Gauges are functions called when
+   someone asks, returning either a number or a list of (labels, number).
+   """
+   
+   buckets = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+   
+   def __init__(self):
+      self.counters = defaultdict(lambda: defaultdict(int))
+      self.histograms = defaultdict(dict)
+      self.gauges = {}
+   
+   def count(self, name, n=1, **labels):
+      self.counters[name][self._key(labels)] += n
+   
+   def observe(self, name, seconds, **labels):
+      hist = self.histograms[name].setdefault(self._key(labels),
+                                              [0] * len(self.buckets) + [0, 0])
+      for i, bound in enumerate(self.buckets):
+         if seconds <= bound:
+            hist[i] += 1
+      hist[-2] += seconds
+      hist[-1] += 1
+   
+   def timed(self, d, name, **labels):
+      "Observes how long until the Deferred d fires."
+      def _done(result, start):
+         self.observe(name, time.time() - start, **labels)
+         return result
+      
+      return d.addBoth(_done, time.time())
+   
+   def gauge(self, name, f):
+      self.gauges[name] = f
+   
+   def as_dict(self):
+      out = {}
+      for name, kind, key, value in self._samples():
+         if kind == 'histogram':
+            value = { 'count': value[-1], 'sum': value[-2],
+                      'buckets': dict((str(b), n) for b, n
+                                      in zip(self.buckets, value)) }
+         out.setdefault(name, {})[','.join('%s=%s' % kv for kv in key)] = value
+      return out
+   
+   def prometheus(self):
+      out = []
+      labels = lambda key: key and '{%s}' % ','.join('%s="%s"' % kv
+                                                     for kv in key) or ''
+      seen = set()
+      
+      for name, kind, key, value in self._samples():
+         if name not in seen:
+            out.append("# TYPE %s %s" % (name, kind))
+            seen.add(name)
+         
+         if kind == 'histogram':
+            bounds = self.buckets + ('+Inf',)
+            for bound, n in zip(bounds, value[:-2] + value[-1:]):
+               out.append('%s_bucket%s %s' % (name,
+                          labels(key + (('le', bound),)), n))
+            out.append('%s_sum%s %s' % (name, labels(key), value[-2]))
+            out.append('%s_count%s %s' % (name, labels(key), value[-1]))
+         else:
+            out.append('%s%s %s' % (name, labels(key), value))
+      
+      return '\n'.join(out) + '\n'
+   
+   def _key(self, labels):
+      return tuple(sorted(labels.items()))
+   
+   def _samples(self):
+      for name in sorted(self.counters):
+         for key, value in sorted(self.counters[name].items()):
+            yield name, 'counter', key, value
+      
+      for name in sorted(self.gauges):
+         values = self.gauges[name]()
+         if not isinstance(values, list):
+            values = [({}, values)]
+         for labels, value in values:
+            yield name, 'gauge', self._key(labels), value
+      
+      for name in sorted(self.histograms):
+         for key, value in sorted(self.histograms[name].items()):
+            yield name, 'histogram', key, value
+
+class MetricsPage(Resource):
+   "Metrics in Prometheus' text format."
+   isLeaf = True
+   
+   def render_GET(self, request):
+      request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+      return metrics.prometheus()
+
+class Profiler(object):
+   """
+   While running, every polling cycle and XML-RPC call goes through call()
+   and is profiled with cProfile until its Deferred fires, so anything else
+   the reactor does meanwhile ends up in the same dump. Dumps go to
+   profile-dir, keeping the newest profile-keep of them; read them with
+   pstats. A watchdog thread also logs the reactor's stack whenever it
+   hasn't come up for air in stall-threshold seconds.
+   """
+   
+   running = False
+   
+   def __init__(self):
+      self.current = self.watchdog = self.beater = None
+      self.seq = 0
+      self.beat = self.reported = 0
+   
+   def start(self):
+      if self.running:
+         return
+      self.running = True
+      self.reactor_thread = thread.get_ident()
+      if not os.path.isdir(self.directory()):
+         os.makedirs(self.directory())
+      
+      if config['stall-threshold'] > 0:
+         self._beat()
+         if not (self.watchdog and self.watchdog.isAlive()):
+            self.watchdog = threading.Thread(target=self._watch,
+                                             args=(config['stall-threshold'],))
+            self.watchdog.setDaemon(True)
+            self.watchdog.start()
+      logging.info("Profiling into %s." % self.directory())
+   
+   def stop(self):
+      self.running = False
+      if self.beater and self.beater.active():
+         self.beater.cancel()
+   
+   def directory(self):
+      return os.path.expanduser(config['profile-dir'])
+   
+   def call(self, name, f, *a, **kw):
+      "Like defer.maybeDeferred(f, *a, **kw), profiled while running."
+      if not self.running or self.current:
+         return defer.maybeDeferred(f, *a, **kw)
+   
+      def _done(result, started):
+         prof.disable()
+         self.current = None
+         self._dump(prof, name, time.time() - started)
+         return result
+      
+      started = time.time()
+      prof = self.current = cProfile.Profile()
+      prof.enable()
+      return defer.maybeDeferred(f, *a, **kw).addBoth(_done, started)
+   
+   def _dump(self, prof, name, took):
+      self.seq += 1
+      path = os.path.join(self.directory(), "%s-%04d-%s.prof"
+                          % (time.strftime("%Y%m%d-%H%M%S"), self.seq % 10000,
+                             name))
+      try:
+         prof.dump_stats(path)
+         old = sorted(n for n in os.listdir(self.directory())
+                      if n.endswith('.prof'))
+         for n in old[:-config['profile-keep']]:
+            os.unlink(os.path.join(self.directory(), n))
+      except (IOError, OSError), e:
+         logging.error("Couldn't write profile %s: %s" % (path, e))
+      else:
+         logging.debug("%s took %.2fs, profile in %s" % (name, took, path))
+   
+   def _beat(self):
+      self.beat = time.time()
+      self.beater = reactor.callLater(config['stall-threshold'] / 4.0,
+                                      self._beat)
+   
+   def _watch(self, threshold):
+      while self.running:
+         time.sleep(threshold / 2.0)
+         beat = self.beat
+         stalled = time.time() - beat
+         if stalled > threshold and beat != self.reported:
+            self.reported = beat
+            frame = sys._current_frames().get(self.reactor_thread)
+            metrics.count('floamtv_reactor_stalls_total')
+            logging.warning("Reactor stalled for %.1fs so far, in:\n%s"
+                            % (stalled, ''.join(traceback.format_stack(frame))))
+
+class ChangeLog(object):
+   """
+   Numbered changes to episodes, for tools that would rather be told than
+   keep asking for status. Each change is a (version, what, floamid, show,
+   number, title) tuple where what is one of new, updated, found, enqueued,
+   probation, fake, wanted or unwanted. Only the newest changes-kept are
+   kept. since() answers right away if there's anything newer than the
+   version asked about, else it parks the caller until there is, or for
+   changes-timeout seconds. Changes recorded together wake them up once.
+   """
+   
+   def __init__(self):
+      self.version = 0
+      self.changes = []
+      self.waiting = []
+      self._wake_call = None
+   
+   def record(self, what, ep):
+      self.version += 1
+      self.changes.append((self.version, what, humanize(ep.tvrageid), ep.show,
+                           ep.number, ep.title))
+      del self.changes[:-config['changes-kept']]
+      if self.waiting and not self._wake_call:
+         self._wake_call = reactor.callLater(0, self._wake)
+   
+   def since(self, version):
+      """
+      A Deferred firing with a struct of the changes after version, the
+      version they bring the caller up to, and missed, which is True if
+      there were changes no longer kept (or the version is from before a
+      restart) so the caller should start over from episodes().
+      """
+      if version != self.version:
+         return defer.succeed(self._after(version))
+      
+      waiting = defer.Deferred()
+      timer = reactor.callLater(config['changes-timeout'], self._expire,
+                                waiting, version)
+      self.waiting.append((waiting, version, timer))
+      return waiting
+   
+   def _after(self, version):
+      behind = self.version - version
+      if 0 <= behind <= len(self.changes):
+         return { 'version': self.version, 'missed': False,
+                  'changes': self.changes[len(self.changes) - behind:] }
+      return { 'version': self.version, 'missed': True,
+               'changes': self.changes }
+   
+   def _wake(self):
+      self._wake_call = None
+      waiting, self.waiting = self.waiting, []
+      for d, version, timer in waiting:
+         timer.cancel()
+         d.callback(self._after(version))
+   
+   def _expire(self, d, version):
+      self.waiting = [w for w in self.waiting if w[0] is not d]
+      d.callback(self._after(version))
+
 class Options(usage.Options):
    def opt_version(self):
       print "floamtv %s" % version
@@ -452,11 +1866,15 @@ class Options(usage.Options):
       ['status',    's', 'Show list of currently wanted episodes, and unwanted'\
                          ' episodes if verbose.'],
       ['daemonize', 'D', 'Causes floamtv to run as a daemon.'],
-      ['shutdown',  'k',  'Quit the running floamtv.']
+      ['shutdown',  'k',  'Quit the running floamtv.'],
+      ['profile',   None, 'Profile what the daemon does, see profile-dir. '\
+                          'Turns it on or off in a running daemon.']
    ]
    optParameters = [
       ['unwant', None, None, 'Set an episode not to download when available'],
       ['rewant', None, None, 'Set an episode to download when available again'],
+      ['migrate', None, None, 'Copy the database into another storage, '\
+                              'file or sqlite'],
    ]
 
 def am_server():
@@ -466,27 +1884,11 @@ def am_server():
       return True
 
 def at_exit(showset):
-   for e in showset._episodes():
-      if e.wanted == 'later':
-         e.wanted = True
-      
    os.unlink(pidfile)
-   showset.save()
+   showset.flush()
+   tvcache.sync()
    logging.info('Graceful exit.')
 
-def check_pid():
-   if os.path.exists(pidfile):
-      with open(pidfile) as f:
-         pid = f.read()
-      
-      try:
-         os.kill(int(pid), 0)
-      except os.error, err:
-         if err.errno == errno.ESRCH:
-            os.unlink(pidfile)
-      else:
-         return int(pid)
-
 def daemonize():
    if os.fork() > 0: sys.exit() 
    os.chdir('/')
@@ -507,9 +1909,152 @@ def defaultize(D, U):
    
    return U
 
+def enqueue_episodes(eps):
+   """
+   Hands episodes to the NZB client by their Newzbin IDs and marks the ones
+   it took as no longer wanted. Hellanzb gets all of them in one batch from a
+   worker thread (see hella_enqueue), SABnzbd gets them all at once through
+   sabqueue. Like sabqueue, IDs already on their way to hellanzb aren't sent
+   again until it has answered.
+   """
+   def _handle_results(results):
+      for ep, took in zip(eps, results):
+         if took:
+            logging.info("Enqueued %s" % ep)
+            ep.wanted = False
+            changelog.record('enqueued', ep)
+         else:
+            logging.error("Unable to enqueue %s" % ep)
+   
+   def _landed(result, newzbinids):
+      hella_enqueue.inflight.difference_update(newzbinids)
+      return result
+   
+   if 'sab' not in config['nzbclient']:
+      eps = [ep for ep in eps if ep.newzbinid not in hella_enqueue.inflight]
+   
+   if not eps:
+      return defer.succeed(None)
+   
+   if 'sab' in config['nzbclient']:
+      attempt = defer.gatherResults([sabqueue.submit(ep.newzbinid)
+                                     for ep in eps])
+   else:
+      newzbinids = [ep.newzbinid for ep in eps]
+      hella_enqueue.inflight.update(newzbinids)
+      attempt = threads.deferToThread(hella_enqueue, newzbinids)
+      attempt.addBoth(_landed, newzbinids)
+   
+   attempt.addCallback(_handle_results)
+   return attempt
+
+def get_page(url, timeout=60, headers=None, online=None):
+   """
+   Like getPage(), but reuses connections (and TLS sessions) through a shared
+   pool of up to pool-size idle connections per host, each kept open for
+   pool-idle seconds. Redirects are followed, as getPage() does. Falls back
+   to getPage() on Twisted versions without HTTPConnectionPool.
+   
+   If online is given, the body is handed to it in lists of lines as it
+   arrives (see BodyLines) and the Deferred fires with None instead.
+   """
+   if not HTTPConnectionPool:
+      page = getPage(url, timeout=timeout, headers=headers)
+      if online:
+         page.addCallback(lambda body: online(body.splitlines()))
+      return page
+   
+   def _body(response):
+      if online and response.code == 200:
+         lines = BodyLines(online)
+         response.deliverBody(lines)
+         return lines.finished
+      
+      def _partial(err):
+         err.trap(client.PartialDownloadError)
+         return err.value.response
+      
+      def _fail(page):
+         raise twisted.web.error.Error(response.code, response.phrase, page)
+      
+      body = readBody(response)
+      body.addErrback(_partial)
+      if response.code != 200:
+         body.addCallback(_fail)
+      return body
+   
+   def _timedout(err):
+      err.trap(defer.CancelledError)
+      raise twisted.internet.error.TimeoutError(url)
+   
+   def _untime(result):
+      if timer.active(): timer.cancel()
+      return result
+   
+   if not get_page.pool:
+      get_page.pool = CountingPool(reactor)
+      get_page.pool.maxPersistentPerHost = config['pool-size']
+      get_page.pool.cachedConnectionTimeout = config['pool-idle']
+   
+   agent = RedirectAgent(Agent(reactor, connectTimeout=timeout,
+                               pool=get_page.pool))
+   headers = Headers(dict((k, [v]) for k, v in (headers or {}).iteritems()))
+   page = agent.request('GET', url, headers)
+   timer = reactor.callLater(timeout, page.cancel)
+   page.addCallback(_body)
+   page.addBoth(_untime)
+   page.addErrback(_timedout)
+   return page
+
+get_page.pool = None
+
 def getpage_err(err):
    return err.trap(twisted.internet.error.ConnectionLost)
 
+def hella_enqueue(newzbinids):
+   """
+   Blocks, so runs in a worker thread. Enqueues newzbinids with hellanzb in
+   one system.multicall, or one call at a time if hellanzb doesn't do
+   multicall. Returns a list with True for each ID hellanzb took. Gives up
+   on a hellanzb that doesn't answer within 60 seconds, as getPage() does.
+   """
+   hella = ServerProxy("http://hellanzb:%s@%s:8760"
+                       % (config['hellanzb-pass'], config['hellanzb-host']),
+                       TimeoutTransport(60))
+   took = []
+   if len(newzbinids) > 1:
+      multi = MultiCall(hella)
+      for nbid in newzbinids:
+         multi.enqueuenewzbin(nbid)
+      
+      try:
+         results = multi()
+      except Fault:
+         pass
+      except:
+         return [False] * len(newzbinids)
+      else:
+         for i in range(len(newzbinids)):
+            try:
+               results[i]
+            except Fault:
+               took.append(False)
+            else:
+               took.append(True)
+         return took
+   
+   for nbid in newzbinids:
+      try:
+         hella.enqueuenewzbin(nbid)
+      except:
+         took.append(False)
+      else:
+         took.append(True)
+   
+   return took
+
+hella_enqueue.inflight = set()
+
 def humanize(q):
    'Converts number to a base33 format, 0-9,a-z except i,l,o (look like digits)'
    if q < 0: raise ValueError, 'must supply a positive integer'
@@ -520,14 +2065,69 @@ def humanize(q):
        converted.insert(0, letters[r])
    return ('').join(converted)
 
-def load():
-   with open(dbpath, 'r') as savefile:
-      ss = yaml.load(savefile)
-      
-      for e in ss._episodes():
-         e.educate()
-         
-      return ss
+def interned(title):
+   "title, interned if it's a plain string so equal titles share memory."
+   if type(title) is str:
+      return intern(title)
+   return title
+
+def load(store=None):
+   "Read the Collection back from storage(), or from store if given."
+   start = time.time()
+   ss, current = (store or storage()).load()
+   ss._reindex()
+   ss._persisted = ss._state() if current else None
+   metrics.observe('floamtv_load_seconds', time.time() - start)
+   return ss
+
+def load_snapshot(savefile):
+   """
+   Snapshots are snapshot_magic followed by a marshalled (version, shows)
+   pair. shows is a list of (title, timezone, episodes, fetched) where each
+   episode is (number, title, tvrageid, airs, newzbinid, wanted, probation)
+   with airs, probation and fetched in seconds since the epoch, UTC.
+   """
+   ver, shows = marshal.load(savefile)
+   if ver != snapshot_version:
+      raise ValueError, "Unknown snapshot version %r in %s" % (ver, dbpath)
+   
+   ss = Collection()
+   for title, timezone, episodes, fetched in shows:
+      show = Show(title, timezone)
+      show.fetched = fetched
+      for fields in episodes:
+         show.episodes.append(Episode.from_fields(show.title, fields))
+      ss.shows.append(show)
+   
+   return ss
+
+def from_epoch(t):
+   if t is not None:
+      return dt.fromtimestamp(t, pytz.utc)
+
+def to_epoch(date):
+   if date is not None:
+      return calendar.timegm(date.utctimetuple())
+
+def migrate(to):
+   """
+   Copies the Collection from the storage the config says to use into the
+   storage called to. Set storage in the config to it afterwards.
+   """
+   if check_pid():
+      return 'Shut floamtv down before migrating.'
+   if to not in storages:
+      return "Unknown storage %r, pick one of %s." \
+         % (to, ', '.join(sorted(storages)))
+   if storages[to] is storage():
+      return "Already using %s storage." % to
+   if not storage().exists():
+      return "There's no database to migrate yet."
+   
+   ss = load()
+   storages[to].replace(ss._dump())
+   logging.info("Copied %d episodes into %s storage. Set 'storage: %s' in %s "
+                "to use it." % (len(list(ss._episodes())), to, to, configpath))
 
 def parse_tvrage(text, wecallit, is_episode):
    if text.startswith('No Show Results'):
@@ -546,7 +2146,11 @@ def parse_tvrage(text, wecallit, is_episode):
    clean = { 'wecallit': wecallit,
              'title':  rage['Show Name'],
              'next':   rage['Next Episode'] and rage['Next Episode'][0],
-             'latest': rage['Latest Episode'] and rage['Latest Episode'][0] }
+             'latest': rage['Latest Episode'] and rage['Latest Episode'][0],
+             'airdates': dict((rage[f][0], rage[f][2])
+                              for f in ('Latest Episode', 'Next Episode')
+                              if isinstance(rage[f], list)
+                              and len(rage[f]) > 2) }
 
    if is_episode:
       clean['tvrageid'] = int(tr.findall(rage['Episode URL'])[-1])
@@ -561,10 +2165,58 @@ def parse_tvrage(text, wecallit, is_episode):
          clean['airs'] = None
    return clean
 
-def relative_datetime(date):
+def query_terms(query):
+   """
+   Splits a Newzbin query, see rule_matcher(), into a list of terms that
+   must be in a title, each a list of alternative regexes, and a list of
+   regexes for terms that mustn't be.
+   """
+   def _unsupported():
+      return ValueError("Can't check query %r against titles" % query)
+   
+   musts, mustnots = [], []
+   joined = False
+   for token in re.findall(r'-?"[^"]*"|\S+', query):
+      if token.lower() == 'or' and musts and not joined:
+         joined = True
+         continue
+      
+      negated = token.startswith('-')
+      words = token.lstrip('-').strip('"').split()
+      if not words or [w for w in words if not re.match(r"[\w'.]+$", w)] \
+            or negated and joined:
+         raise _unsupported()
+      
+      term = re.compile(r'\b%s\b' % r'\s+'.join(map(re.escape, words)), re.I)
+      if negated:
+         mustnots.append(term)
+      elif joined:
+         musts[-1].append(term)
+      else:
+         musts.append([term])
+      joined = False
+   
+   if joined:
+      raise _unsupported()
+   return musts, mustnots
+
+def rageid_from_url(url):
+   "The TVRage episode ID at the end of a tvrage.com URL, or None."
+   if 'tvrage.com/' not in url:
+      return None
+   
+   tail = url.rstrip('/').rsplit('/', 1)[-1]
+   if tail.isdigit() and len(tail) >= 4:
+      return int(tail)
+   
+   found = tr.findall(url)
+   return found and int(found[0]) or None
+
+def relative_datetime(date, today=None):
+   "Pass today, in localtz, to save looking it up when doing lots of these."
    if date:
       date = date.astimezone(localtz)
-      diff = date.date() - dt.now(localtz).date()
+      diff = date.date() - (today or dt.now(localtz).date())
 
       if diff.days == 0:
          return "airs %s today"      % date.strftime("%I:%M %p")
@@ -580,22 +2232,106 @@ def relative_datetime(date):
          return "airs on %s"         % date.strftime("%m/%d/%Y")
    else: return 'Unknown Airtime'
 
-def search_newzbin(sepis, rdict):
-   def _process_results(contents, sepis):
-      rd = csv.reader(StringIO(contents))
-      try:
-         results = [(int((tr.findall(r[4]) or [0])[0]), int(r[1])) for r in rd]
-         tvrageids = set(tvid for tvid, nbid in results)
-      except IndexError:
-         tvrageids = []
-      
-      for ep in (e for e in sepis if e.tvrageid in tvrageids):
-         for tvid, nbid in results:
-            if tvid == ep.tvrageid:
-               ep.newzbinid = nbid
-               break
-   
-   query = urlencode({ 'searchaction': 'Search',
+def replay_journal(ss):
+   """
+   Apply the changes recorded in the journal since the last snapshot, see
+   Collection._changes().
+   """
+   if not os.path.exists(dbpath + '.journal'):
+      return
+   
+   shows = dict((s.title, s) for s in ss.shows)
+   eps = dict(((e.show, e.number), e) for e in ss._episodes())
+   with open(dbpath + '.journal', 'rb') as journal:
+      while True:
+         try:
+            show, number, changes = marshal.load(journal)
+         except (EOFError, ValueError, TypeError):
+            break
+         
+         if number is None:
+            if show in shows:
+               shows[show].fetched = changes['fetched']
+         elif changes is None:
+            if (show, number) in eps:
+               shows[show].episodes.remove(eps.pop((show, number)))
+         elif isinstance(changes, tuple):
+            if show in shows and (show, number) not in eps:
+               ep = Episode.from_fields(show, changes)
+               shows[show].episodes.append(ep)
+               eps[show, number] = ep
+         elif (show, number) in eps:
+            if 'airs' in changes:
+               changes['airs'] = from_epoch(changes['airs'])
+            for attr, value in changes.iteritems():
+               setattr(eps[show, number], attr, value)
+
+def rule_matcher(rdict):
+   """
+   The rules in rdict (see defaults['rules']) as a function telling whether
+   a post, as NewzbinResults keeps them, passes them. Posts pass the size
+   rules if the feed didn't say how big they are. Like Newzbin, a post
+   passes query if every word of it is in the post's title. Of Newzbin's
+   query syntax only -word (mustn't be there), "quoted phrases" and a or b
+   are understood, see query_terms(). Raises ValueError for any other
+   query, attribute searches for instance, which a title can't answer.
+   """
+   low = float(rdict['min-megs'] or 0)
+   high = rdict['max-megs'] and float(rdict['max-megs'])
+   groups = frozenset(rdict['groups'] or ())
+   musts, mustnots = query_terms(str(rdict['query'] or ''))
+   
+   def matches(post):
+      newzbinid, megs, postgroups, title = post
+      if megs is not None and (megs < low or high and megs > high):
+         return False
+      if groups and not groups & postgroups:
+         return False
+      for alternatives in musts:
+         if not [a for a in alternatives if a.search(title)]:
+            return False
+      for term in mustnots:
+         if term.search(title):
+            return False
+      return True
+   
+   return matches
+
+def search_newzbin(sepis, rdict, posts=None, accepts=None):
+   """
+   Looks the episodes in sepis up on Newzbin using the rules in rdict, and
+   sets newzbinid on the ones that are there. Episodes are searched for
+   newzbin-batch at a time. A batch whose results hit Newzbin's row cap may
+   have lost older posts off the end, so the episodes it didn't find are
+   searched for again in two smaller batches. If posts is given, no
+   newzbinids are set, instead posts gets a list of every post found for
+   each TVRage ID, newest first, see NewzbinResults. An episode then only
+   counts as found once accepts(episode, post) likes one of its posts, as
+   the search itself didn't apply the rules that decide that.
+   """
+   def _process_results(_, shard, results):
+      if posts is not None:
+         for tvid, found in results.posts.iteritems():
+            posts.setdefault(tvid, []).extend(found)
+         missed = [e for e in shard
+                   if not [p for p in posts.get(e.tvrageid, ())
+                           if accepts(e, p)]]
+      else:
+         for ep in shard:
+            found = results.found.get(ep.tvrageid)
+            if found is not None and found != ep.newzbinid:
+               ep.newzbinid = found
+               changelog.record('found', ep)
+         missed = [e for e in shard if e.tvrageid not in results.found]
+      
+      if results.rows >= rowcap and missed and len(shard) > 1:
+         half = (len(missed) + 1) / 2
+         shards = [missed[:half], missed[half:]]
+         return defer.DeferredList([_search(sh) for sh in shards if sh])
+   
+   def _search(shard):
+      results = NewzbinResults((e.tvrageid for e in shard), posts is not None)
+      query = urlencode({ 'searchaction': 'Search',
              'group': (' or ').join(rdict['groups']) if rdict['groups'] else '',
              'q': rdict['query'] or '',
              'category': 8,
@@ -603,23 +2339,28 @@ def search_newzbin(sepis, rdict):
              'u_post_states': 3,
              'u_post_larger_than': rdict['min-megs'] or '',
              'u_post_smaller_than': rdict['max-megs'] or '',
-             'q_url': (' or ').join([str(e.tvrageid) for e in sepis]),
+             'q_url': (' or ').join([str(e.tvrageid) for e in shard]),
              'sort': 'ps_edit_date',
              'order': 'desc',
-             'u_post_results_amt': 999,
+             'u_post_results_amt': rowcap,
              'u_v3_retention': config['retention'] * 24 * 60 * 60,
              'fpn': 'p', 
              'feed': 'csv' })
+      
+      search = scheduler.fetch("%s?%s" % (config['newzbin-url'], query),
+                               SEARCH, timeout=60, online=results.feed,
+                               headers={"Authorization": authheader})
+      search.addCallback(_process_results, shard, results)
+      search.addErrback(getpage_err)
+      return search
    
    basicauth = base64.encodestring("%s:%s" % (config.get('newzbin-user'), 
                                                config.get('newzbin-password')))
    authheader = "Basic %s" % basicauth.strip()
    
-   search = getPage("https://www.newzbin.com/search/?%s" % query, timeout=60,
-                    headers={"Authorization": authheader})
-   search.addCallback(_process_results, sepis)
-   search.addErrback(getpage_err)
-   return search
+   size = max(1, config['newzbin-batch'])
+   return defer.DeferredList([_search(sepis[i:i + size])
+                              for i in range(0, len(sepis), size)])
 
 def set_up_logging(where):
    class ignr(logging.Filter):
@@ -640,19 +2381,85 @@ def set_up_logging(where):
       observer = log.DefaultObserver()
    observer.start()
    
+def storage():
+   "The storage backend the config asks for."
+   try:
+      return storages[config['storage']]
+   except KeyError:
+      raise ValueError, "Unknown storage %r, pick one of %s." \
+         % (config['storage'], ', '.join(sorted(storages)))
+
 def tvrageerr(err):
    return err.trap(ValueError)
 
 def tvrage_info(show_name, episode):
-   episode = episode or ''
-   u = urlencode({'show': show_name, 'ep': episode})
-   info = getPage("http://tvrage.com/quickinfo.php?%s" % u, timeout=60)
-   info.addCallback(parse_tvrage, show_name, episode != '')
-   return info
+   """
+   What TVRage says about show_name, or about one of its episodes, as
+   parse_tvrage() makes of it. Answers come out of tvcache when they can.
+   Everyone asking for the same thing while it's on its way shares the one
+   request, and gets their own copy of the answer.
+   """
+   def _answer(result, key):
+      for waiting in tvrage_info.inflight.pop(key):
+         if isinstance(result, failure.Failure):
+            waiting.errback(result)
+         else:
+            waiting.callback(dict(result))
+   
+   key = (show_name, episode or '')
+   cached = tvcache.get(key)
+   if cached:
+      return defer.succeed(cached)
+   
+   waiting = defer.Deferred()
+   if key in tvrage_info.inflight:
+      metrics.count('floamtv_tvrage_coalesced_total')
+      tvrage_info.inflight[key].append(waiting)
+      return waiting
+   
+   tvrage_info.inflight[key] = [waiting]
+   u = urlencode({'show': show_name, 'ep': key[1]})
+   info = scheduler.fetch("%s?%s" % (config['tvrage-url'], u), REFRESH,
+                          timeout=60)
+   info.addCallback(parse_tvrage, show_name, key[1] != '')
+   info.addCallback(tvcache.store, key)
+   info.addBoth(_answer, key)
+   return waiting
+
+tvrage_info.inflight = {}
+
+tvcache = TVRageCache()
+storages = { 'file': FileStorage(), 'sqlite': SQLiteStorage() }
+scheduler = Scheduler()
+sabqueue = SabQueue()
+metrics = Metrics()
+profiler = Profiler()
+changelog = ChangeLog()
+
+metrics.gauge('floamtv_requests_in_flight', lambda: [({ 'host': host },
+               s['active']) for host, s in scheduler.stats().iteritems()])
+metrics.gauge('floamtv_requests_queued', lambda: [({ 'host': host },
+               s['queued']) for host, s in scheduler.stats().iteritems()])
+metrics.gauge('floamtv_tvrage_cache', lambda: [({ 'stat': stat }, n)
+               for stat, n in tvcache.stats().iteritems()])
+metrics.gauge('floamtv_sab_in_flight', lambda: len(sabqueue.inflight))
+metrics.gauge('floamtv_changes_waiting', lambda: len(changelog.waiting))
+metrics.gauge('floamtv_http_connections', lambda: get_page.pool and
+              [({ 'stat': 'requests' }, get_page.pool.requests),
+               ({ 'stat': 'connects' }, get_page.pool.connects)] or [])
+
+def log_connection_stats():
+   if get_page.pool:
+      logging.info("HTTP: %d requests, %d new connections, %d reused."
+                   % (get_page.pool.requests, get_page.pool.connects,
+                      get_page.pool.requests - get_page.pool.connects))
 
 def main():
    set_up_logging(config['logfile'])
-      
+   
+   if options['migrate']:
+      return migrate(options['migrate'])
+   
    if not am_server() and any(options.values()):
       showset = ServerProxy('http://localhost:19666/')
       
@@ -672,7 +2479,7 @@ def main():
       with open(pidfile, "w") as f:
          f.write("%d" % os.getpid())
    
-      if os.path.exists(dbpath):
+      if storage().exists():
          showset = load()
          first = False
       else:
@@ -680,24 +2487,37 @@ def main():
          first = True
       
    if options['unwant']:
-      for show in options['unwant'].split(' '):
-         logging.info(showset.unwant(show))
+      for out in showset.unwant_many(options['unwant'].split()):
+         logging.info(out)
    
    elif options['rewant']:
-      for show in options['rewant'].split(' '):
-         logging.info(showset.rewant(show))
+      for out in showset.rewant_many(options['rewant'].split()):
+         logging.info(out)
    
    elif options['status']:
       logging.info(showset.status(bool(options['verbose'])))
+   
+   elif options['profile'] and not am_server():
+      logging.info(showset.profile())
       
    elif am_server():
       atexit.register(at_exit, showset)
+      showset.schedule_probation()
+      if options['profile']:
+         profiler.start()
+      
+      tasks['tvrage'] = Poller(showset.tvrage_delay, showset.poll_tvrage,
+                               config['sets'], first)
+      tasks['newzbin'] = Poller(showset.newzbin_delay, showset.look_on_newzbin)
+      tasks['tvrage'].start()
       
-      tasks['tvrage'] = task.LoopingCall(showset.refresh, config['sets'], first)
-      tasks['newzbin'] = task.LoopingCall(showset.look_on_newzbin)
-      tasks['tvrage'].start(60 * config['tvrage-interval'])
+      metrics.gauge('floamtv_shows', lambda: len(showset.shows))
+      metrics.gauge('floamtv_episodes', showset.counts)
+      root = Resource()
+      root.putChild('', showset)
+      root.putChild('metrics', MetricsPage())
       
-      reactor.listenTCP(19666, server.Site(showset), interface=config['bind'])
+      reactor.listenTCP(19666, server.Site(root), interface=config['bind'])
       reactor.run()
 
 if __name__ == '__main__':